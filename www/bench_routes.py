@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+# -*- coding=utf-8 -*-
+
+'''
+Compare the linear regex scan with transwarp.web.Router on 1,000 routes.
+
+Usage: python bench_routes.py [routes]
+'''
+
+import sys, time
+sys.path.append('transwarp')
+
+from web import get, Route, Router, StaticFileRoute
+
+
+def make_routes(n):
+    L = []
+    for i in xrange(n):
+        L.append(Route(get('/api/res%d/:id' % i)(lambda *args: args)))
+        L.append(Route(get('/api/res%d/:id/items/:item' % i)(lambda *args: args)))
+    return L
+
+
+def linear(routes, path):
+    for fn in routes:
+        args = fn.match(path)
+        if args:
+            return fn, args
+    return None
+
+
+def measure(label, fn, paths, loops=20):
+    start = time.time()
+    for i in xrange(loops):
+        for p in paths:
+            fn(p)
+    elapsed = time.time() - start
+    print '%-28s %8.2f us/match' % (label, elapsed * 1000000 / (loops * len(paths)))
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    routes = make_routes(n // 2)
+    scan = routes + [StaticFileRoute()]
+    router = Router()
+    for r in scan:
+        router.add(r)
+    print '%d dynamic routes' % len(routes)
+    for label, paths in (('first route', ['/api/res0/1']), ('last route', ['/api/res%d/1/items/2' % (n // 2 - 1)]), ('static file', ['/static/css/uikit.min.css'])):
+        measure('linear, %s' % label, lambda p: linear(scan, p), paths)
+        measure('router, %s' % label, router.match, paths)
@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+# -*- coding=utf-8 -*-
+
+'''
+Compare Dict rows with tuple-backed Row objects built by transwarp.db.
+
+Usage: python bench_rows.py [rows]
+'''
+
+import sys, time, gc
+sys.path.append('transwarp')
+
+import db
+
+NAMES = ['id', 'user_id', 'user_name', 'name', 'summary', 'content', 'created_at']
+
+
+def make_values(n):
+    return [('%050d' % i, '%050d' % (i % 97), u'user', u'blog %d' % i, u'summary', u'content', 1405000000.0 + i) for i in xrange(n)]
+
+
+def build(factory, values):
+    # same work as _select(): one factory call per query, one row per result:
+    make_row = factory(list(NAMES))
+    return map(make_row, values)
+
+
+def measure(label, factory, values):
+    gc.collect()
+    start = time.time()
+    rows = build(factory, values)
+    elapsed = time.time() - start
+    size = sum(sys.getsizeof(r) for r in rows)
+    print '%-10s %8d rows  %8.1f ms  %10d bytes of row objects (%d per row)' % (label, len(rows), elapsed * 1000, size, size // len(rows))
+    return rows
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    values = make_values(n)
+    measure('Dict', db.dict_row, values)
+    measure('Row', db.tuple_row, values)
@@ -12,9 +12,36 @@ configs = {
         'port': 3306,
         'user': 'root',
         'password': 'admin',
-        'database': 'awesome'
+        'database': 'awesome',
+        # read replicas, e.g. [{'host': '10.0.0.2'}] or ['10.0.0.3:3306']:
+        'replicas': []
     },
     'session': {
         'secret': 'AwEsOmE'
+    },
+    'compress': {
+        'level': 6,
+        'min_size': 1024
+    },
+    'template': {
+        'bytecode_cache': True,
+        'auto_reload': True,
+        'precompile': True
+    },
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        # caches are invalidated per process, with workers > 0 a signed in user
+        # changed or deleted in one worker is trusted by the others for up to 5s:
+        'workers': 0,
+        'threads': 1,
+        'queue_size': 64,
+        'deadline': 30,
+        'event_loop': False,
+        # serve /static/ from the app, None for the debug server only:
+        'static_files': None
+    },
+    'markdown': {
+        'cache_bytes': 32 * 1024 * 1024
     }
 }
@@ -3,12 +3,15 @@
 
 import time, uuid
 
-from db import next_id
+from db import next_id, after_commit
 from orm import Model, StringField, BooleanField, FloatField, TextField
+from web import invalidate
 
 
 class User(Model):
     __table__ = 'users'
+    __identity_map__ = True
+    __cache__ = dict(ttl=60, max_entries=100000)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(updatable=False, ddl='varchar(50)')
@@ -18,9 +21,18 @@ class User(Model):
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(updatable=False, default=time.time)
 
+    def post_update(self):
+        # drop verified sessions, the password or admin flag may have changed.
+        # after commit, or another thread could cache the old row again:
+        after_commit(lambda: invalidate('user:%s' % self.id))
+
+    post_delete = post_update
+
 
 class Blog(Model):
     __table__ = 'blogs'
+    __identity_map__ = True
+    __count_cache__ = dict(ttl=60)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(updatable=False, ddl='varchar(50)')
@@ -30,6 +42,11 @@ class Blog(Model):
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
 
+    def post_insert(self):
+        after_commit(lambda: invalidate('blogs', 'blog:%s' % self.id))
+
+    post_update = post_delete = post_insert
+
 
 class Comment(Model):
     __table__ = 'comments'
@@ -41,3 +58,8 @@ class Comment(Model):
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
+
+    def post_insert(self):
+        after_commit(lambda: invalidate('blog:%s' % self.blog_id))
+
+    post_update = post_delete = post_insert
@@ -0,0 +1,688 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+Non-blocking twin of the db module.
+
+select(), select_one(), select_int(), update() and insert() take the same
+arguments as in db but return a Future at once. The SQL runs on a thread
+owned by a pooled connection, so callers never wait on the database.
+
+Futures are awaited by yielding them from a @coroutine generator, which
+returns its value by raising Return:
+
+    @coroutine
+    def count_users():
+        n = yield select_int('select count(id) from users')
+        raise Return(n)
+
+with_transaction and with_connection wrap a coroutine like their db
+counterparts, nested transactions join the outer one. The wire driver is
+pluggable: MySQLDriver for mysql.connector, SQLiteDriver for tests, or a
+subclass of Driver.
+'''
+
+import sys
+import time
+import Queue
+import logging
+import threading
+import functools
+import collections
+
+from db import Dict, DBError, MultiColumnsError, tuple_row, _pop_factory
+
+
+class Future(object):
+    '''
+    Result of an operation that may not have completed yet.
+
+    >>> f = Future()
+    >>> L = []
+    >>> f.add_done_callback(lambda f: L.append(f.result()))
+    >>> f.done(), L
+    (False, [])
+    >>> f.set_result(1)
+    >>> f.done(), L
+    (True, [1])
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        '''
+        Wait for the result, re-raising the exception of a failed operation.
+        '''
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise DBError('Operation not done in %s seconds.' % timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exc_info(self):
+        return self._exc_info
+
+    def add_done_callback(self, fn):
+        '''
+        Call fn(future) once done, at once if it already is.
+        '''
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exc_info(self, exc_info):
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        with self._cond:
+            if self._done:
+                raise DBError('Future is already done.')
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = None
+            self._cond.notify_all()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('future callback failed:')
+
+
+def _chain(source, target):
+    '''
+    Copy the outcome of future source to future target when done.
+    '''
+    def _done(f):
+        if f.exc_info():
+            target.set_exc_info(f.exc_info())
+        else:
+            target.set_result(f.result())
+    source.add_done_callback(_done)
+    return target
+
+
+class Return(Exception):
+    '''
+    Raised by a @coroutine generator to return a value.
+    '''
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+class _Context(object):
+    '''
+    Connection and transaction depth of a coroutine and the coroutines it
+    calls, what _DbCtx holds per thread in the db module.
+    '''
+
+    def __init__(self):
+        self.connection = None
+        self.transactions = 0
+
+
+# the _Context of the coroutine step running in this thread:
+_local = threading.local()
+
+
+def _current():
+    return getattr(_local, 'context', None)
+
+
+class _Runner(object):
+
+    def __init__(self, gen, future, context):
+        self.gen = gen
+        self.future = future
+        self.context = context
+
+    def step(self, value=None, exc_info=None):
+        # resolved futures are handled in the loop, not by recursion:
+        while True:
+            outer = _current()
+            _local.context = self.context
+            try:
+                if exc_info:
+                    yielded = self.gen.throw(*exc_info)
+                else:
+                    yielded = self.gen.send(value)
+            except (StopIteration, Return), e:
+                self.future.set_result(getattr(e, 'value', None))
+                return
+            except Exception:
+                self.future.set_exc_info(sys.exc_info())
+                return
+            finally:
+                _local.context = outer
+            if not isinstance(yielded, Future):
+                value, exc_info = None, (TypeError, TypeError('A coroutine must yield a Future, got %r.' % (yielded, )), None)
+                continue
+            if not yielded.done():
+                yielded.add_done_callback(self._resume)
+                return
+            value, exc_info = yielded._result, yielded._exc_info
+
+    def _resume(self, f):
+        self.step(f._result, f._exc_info)
+
+
+def coroutine(func):
+    '''
+    Make generator function func return a Future. Every Future it yields is
+    waited for and its result sent back. A coroutine called by another one
+    shares its connection and transaction.
+
+    >>> @coroutine
+    ... def add(a, b):
+    ...     x = yield _resolved(a)
+    ...     raise Return(x + b)
+    >>> add(1, 2).result()
+    3
+    '''
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        future = Future()
+        try:
+            gen = func(*args, **kw)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+            return future
+        if not hasattr(gen, 'send'):
+            future.set_result(gen)
+            return future
+        _Runner(gen, future, _current() or _Context()).step()
+        return future
+    return _wrapper
+
+
+def _resolved(value):
+    f = Future()
+    f.set_result(value)
+    return f
+
+
+def gather(*futures):
+    '''
+    Return a Future of the list of results of futures, failing with the first error.
+    '''
+    result = Future()
+    values = [None] * len(futures)
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def _done(i, f):
+        with lock:
+            if result.done():
+                return
+            if f.exc_info():
+                result.set_exc_info(f.exc_info())
+                return
+            values[i] = f.result()
+            pending[0] = pending[0] - 1
+            if pending[0]:
+                return
+        result.set_result(values)
+
+    if not futures:
+        result.set_result(values)
+    for i, f in enumerate(futures):
+        f.add_done_callback(functools.partial(_done, i))
+    return result
+
+
+class Driver(object):
+    '''
+    Wire driver: connect() returns a DB-API 2 connection, paramstyle is
+    'format' or 'qmark' and tells how '?' placeholders are sent.
+    '''
+
+    paramstyle = 'qmark'
+
+    def connect(self):
+        raise NotImplementedError
+
+    def format(self, sql):
+        if self.paramstyle == 'format':
+            return sql.replace('?', '%s')
+        return sql
+
+
+class MySQLDriver(Driver):
+    '''
+    mysql.connector with the same defaults as db.create_engine().
+    '''
+
+    paramstyle = 'format'
+
+    def __init__(self, user, password, database, host='127.0.0.1', port=3306, **kw):
+        params = dict(user=user, password=password, database=database, host=host, port=port, \
+                charset='utf8', collation='utf8_general_ci', autocommit=False)
+        params.update(kw)
+        params['buffered'] = True
+        self.params = params
+
+    def connect(self):
+        import mysql.connector
+        return mysql.connector.connect(**self.params)
+
+
+class SQLiteDriver(Driver):
+    '''
+    sqlite3, for tests. An in-memory database is private to one connection,
+    use max_size=1 with ':memory:'.
+    '''
+
+    def __init__(self, database, **kw):
+        self.database = database
+        self.kw = kw
+
+    def connect(self):
+        import sqlite3
+        # each connection is used by its own thread only, but not the one creating it:
+        return sqlite3.connect(self.database, check_same_thread=False, **self.kw)
+
+
+class _AsyncConnection(object):
+    '''
+    A raw connection with its own thread running submitted operations in order.
+    '''
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.raw = None
+        self.created_at = time.time()
+        self._queue = Queue.Queue()
+        t = threading.Thread(target=self._work, name='transwarp-adb-%s' % hex(id(self)))
+        t.daemon = True
+        t.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fn, future = item
+            try:
+                if self.raw is None:
+                    self.raw = self.driver.connect()
+                r = fn(self.raw)
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(r)
+
+    def submit(self, fn):
+        '''
+        Run fn(raw_connection) on the connection thread and return a Future of its result.
+        '''
+        future = Future()
+        self._queue.put((fn, future))
+        return future
+
+    def commit(self):
+        return self.submit(lambda raw: raw.commit())
+
+    def rollback(self):
+        return self.submit(lambda raw: raw.rollback())
+
+    def close(self):
+        def _close(raw):
+            raw.close()
+        f = self.submit(_close)
+        self._queue.put(None)
+        return f
+
+
+class AsyncPool(object):
+    '''
+    Bounded pool of _AsyncConnection. acquire() returns a Future that is
+    resolved when a connection is free, no thread waits for it.
+
+    >>> pool = AsyncPool(SQLiteDriver(':memory:'), max_size=1)
+    >>> c1 = pool.acquire().result()
+    >>> f = pool.acquire()
+    >>> f.done(), pool.stats().waiting
+    (False, 1)
+    >>> pool.release(c1)
+    >>> f.result() is c1
+    True
+    >>> pool.close()
+    '''
+
+    def __init__(self, driver, max_size=10, max_lifetime=3600.0):
+        if max_size < 1:
+            raise ValueError('Invalid pool size: max_size=%s' % max_size)
+        self.driver = driver
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+        self._waiters = collections.deque()
+        self._size = 0
+        self._acquires = 0
+        self._waits = 0
+
+    def acquire(self):
+        future = Future()
+        with self._lock:
+            self._acquires = self._acquires + 1
+            if self._idle:
+                conn = self._idle.pop()
+            elif self._size < self.max_size:
+                self._size = self._size + 1
+                conn = None
+            else:
+                self._waits = self._waits + 1
+                self._waiters.append(future)
+                return future
+        future.set_result(conn or _AsyncConnection(self.driver))
+        return future
+
+    def release(self, conn):
+        '''
+        Roll back conn on its thread and hand it to the next waiter.
+        '''
+        def _released(f):
+            if f.exc_info() or (self.max_lifetime and time.time() - conn.created_at > self.max_lifetime):
+                if f.exc_info():
+                    logging.warning('rollback on release failed, discard connection <%s>.' % hex(id(conn)))
+                conn.close()
+                with self._lock:
+                    if not self._waiters:
+                        self._size = self._size - 1
+                        return
+                    waiter = self._waiters.popleft()
+                waiter.set_result(_AsyncConnection(self.driver))
+                return
+            with self._lock:
+                if not self._waiters:
+                    self._idle.append(conn)
+                    return
+                waiter = self._waiters.popleft()
+            waiter.set_result(conn)
+        conn.rollback().add_done_callback(_released)
+
+    def close(self):
+        with self._lock:
+            L = list(self._idle)
+            self._idle.clear()
+            self._size = self._size - len(L)
+        for conn in L:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return Dict(size=self._size, idle=len(self._idle), waiting=len(self._waiters), \
+                    max_size=self.max_size, acquires=self._acquires, waits=self._waits)
+
+
+# global pool, the twin of db.engine:
+engine = None
+
+
+def create_engine(driver=None, **kw):
+    '''
+    Init the global pool. driver defaults to MySQLDriver(**kw). max_size and
+    max_lifetime are pool args.
+    '''
+    global engine
+    if engine is not None:
+        raise DBError('Engine is already initialized.')
+    pool_kw = dict((k, kw.pop(k)) for k in ('max_size', 'max_lifetime') if k in kw)
+    if driver is None:
+        driver = MySQLDriver(**kw)
+    engine = AsyncPool(driver, **pool_kw)
+    logging.info('Init async engine <%s> ok.' % hex(id(engine)))
+
+
+def _run(op, autocommit=False):
+    '''
+    Run op(raw) on the connection of the current coroutine if it holds one,
+    otherwise on a connection acquired for op only. With autocommit, commit
+    after op like db does outside transactions.
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+
+    def _run_and_commit(raw):
+        r = op(raw)
+        if autocommit:
+            logging.info('auto commit')
+            raw.commit()
+        return r
+
+    context = _current()
+    if context and context.connection:
+        return context.connection.submit(_run_and_commit)
+    future = Future()
+
+    def _acquired(f):
+        if f.exc_info():
+            future.set_exc_info(f.exc_info())
+            return
+        conn = f.result()
+
+        def _done(rf):
+            engine.release(conn)
+            _chain(rf, future)
+        conn.submit(_run_and_commit).add_done_callback(_done)
+    engine.acquire().add_done_callback(_acquired)
+    return future
+
+
+def _execute(raw, sql, args):
+    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    cursor = raw.cursor()
+    cursor.execute(engine.driver.format(sql), args)
+    return cursor
+
+
+def _select(sql, first, factory, *args):
+    def _op(raw):
+        cursor = _execute(raw, sql, args)
+        try:
+            make_row = factory([x[0] for x in cursor.description])
+            if first:
+                values = cursor.fetchone()
+                return make_row(values) if values else None
+            return map(make_row, cursor.fetchall())
+        finally:
+            cursor.close()
+    return _run(_op)
+
+
+def select_one(sql, *args, **kw):
+    '''
+    Return a Future of the first row or None.
+    '''
+    return _select(sql, True, _pop_factory(kw), *args)
+
+
+@coroutine
+def select_int(sql, *args):
+    '''
+    Return a Future of the single int result.
+    '''
+    d = yield _select(sql, True, tuple_row, *args)
+    if len(d) != 1:
+        raise MultiColumnsError('Expect only one column')
+    raise Return(d[0])
+
+
+def select(sql, *args, **kw):
+    '''
+    Return a Future of the list of rows.
+    '''
+    return _select(sql, False, _pop_factory(kw), *args)
+
+
+def _update(sql, *args):
+    def _op(raw):
+        cursor = _execute(raw, sql, args)
+        try:
+            return cursor.rowcount
+        finally:
+            cursor.close()
+    context = _current()
+    return _run(_op, autocommit=not (context and context.transactions))
+
+
+def insert(table, **kw):
+    '''
+    Return a Future of the inserted row count.
+    '''
+    cols, args = zip(*kw.iteritems())
+    sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join('`%s`' % col for col in cols), ','.join(['?' for i in range(len(cols))]))
+    return _update(sql, *args)
+
+
+def update(sql, *args):
+    '''
+    Return a Future of the affected row count.
+    '''
+    return _update(sql, *args)
+
+
+def _scoped(call, transactional):
+    '''
+    Run coroutine call() holding one connection, in a transaction if
+    transactional. Nested scopes reuse the connection and join the transaction.
+    '''
+    context = _current()
+    if context is None or context.connection is None:
+        # a new scope gets its own context, so coroutines started side by side
+        # (e.g. by gather) do not share a connection or a transaction:
+        context = _Context()
+    future = Future()
+    _Runner(_scope(context, call, transactional), future, context).step()
+    return future
+
+
+def _scope(context, call, transactional):
+    acquired = False
+    if context.connection is None:
+        context.connection = yield engine.acquire()
+        acquired = True
+    if transactional:
+        context.transactions = context.transactions + 1
+        logging.info('begin transaction...' if context.transactions == 1 else 'join current transation...')
+    try:
+        try:
+            r = yield call()
+        except Exception:
+            exc_info = sys.exc_info()
+            if transactional:
+                context.transactions = context.transactions - 1
+                if context.transactions == 0:
+                    logging.warning('rollback transaction...')
+                    yield context.connection.rollback()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if transactional:
+            context.transactions = context.transactions - 1
+            if context.transactions == 0:
+                logging.info('commit transaction...')
+                try:
+                    yield context.connection.commit()
+                except Exception:
+                    exc_info = sys.exc_info()
+                    logging.warning('commit failed. try rollback...')
+                    yield context.connection.rollback()
+                    raise exc_info[0], exc_info[1], exc_info[2]
+        raise Return(r)
+    finally:
+        if acquired:
+            conn = context.connection
+            context.connection = None
+            engine.release(conn)
+
+
+def with_connection(func):
+    '''
+    Decorator running coroutine func with one connection for all its queries.
+    Writes are committed one by one as outside any transaction.
+
+    >>> @with_connection
+    ... def add_and_count(id):
+    ...     yield insert('tx', id=id, name='c')
+    ...     n = yield select_int('select count(*) from tx where id=?', id)
+    ...     raise Return(n)
+    >>> add_and_count(10).result()
+    1
+    >>> select_int('select count(*) from tx where id=?', 10).result()
+    1
+    >>> update('delete from tx where id=?', 10).result()
+    1
+    '''
+    func = coroutine(func)
+
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        return _scoped(lambda: func(*args, **kw), False)
+    return _wrapper
+
+
+def with_transaction(func):
+    '''
+    Decorator running coroutine func in a transaction, committed when it
+    returns and rolled back when it raises. Called from a coroutine already
+    in a transaction, it joins that one.
+
+    >>> @with_transaction
+    ... def add(id, name, fail=False):
+    ...     yield insert('tx', id=id, name=name)
+    ...     if fail:
+    ...         raise ValueError('add failed')
+    >>> @with_transaction
+    ... def add_two(fail):
+    ...     yield add(1, 'a')
+    ...     yield add(2, 'b', fail)
+    >>> add_two(True).result()
+    Traceback (most recent call last):
+      ...
+    ValueError: add failed
+    >>> select_int('select count(*) from tx').result()
+    0
+    >>> add_two(False).result()
+    >>> select('select name from tx order by id').result()
+    [{'name': u'a'}, {'name': u'b'}]
+    >>> @coroutine
+    ... def add_side_by_side():
+    ...     yield gather(add(3, 'c'), add(4, 'd'))
+    >>> add_side_by_side().result()
+    >>> select_int('select count(*) from tx where id>2').result()
+    2
+    '''
+    func = coroutine(func)
+
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        return _scoped(lambda: func(*args, **kw), True)
+    return _wrapper
+
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.WARNING)
+    create_engine(SQLiteDriver(':memory:'), max_size=1)
+    update('create table tx (id int primary key, name text)').result()
+    import doctest
+    doctest.testmod()
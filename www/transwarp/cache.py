@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+In-process cache stores shared by the db, orm and web modules.
+'''
+
+import time
+import threading
+import collections
+
+
+class CacheBackend(object):
+    '''
+    Interface of a cache store. Subclass it to plug in an out-of-process store,
+    values must then be picklable. Keys are str or unicode.
+    '''
+
+    def get(self, key, default=None):
+        '''
+        Return the value of key, or default if missing or expired.
+        '''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        '''
+        Store value under key. ttl is in seconds, None for the store's default.
+        '''
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        '''
+        Return counters as a dict, at least hits and misses.
+        '''
+        return dict()
+
+
+class LocalCache(CacheBackend):
+    '''
+    Thread-safe in-memory store with LRU eviction and per-entry TTL.
+
+    Args:
+        ttl: default seconds an entry lives, 0 or None for no expiration.
+        max_entries: entries kept before the least recently used is evicted.
+        max_bytes: total len() of values kept, None for no limit. Values must
+            then be str or unicode.
+
+    >>> c = LocalCache(ttl=60, max_entries=2)
+    >>> c.set('a', 1)
+    >>> c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> c.set('d', 4, ttl=-1)
+    >>> c.get('d', 'expired')
+    'expired'
+    >>> st = c.stats()
+    >>> st['hits'], st['misses'], st['evictions'], st['expirations'], st['size']
+    (1, 2, 2, 1, 1)
+    >>> c = LocalCache(ttl=0, max_bytes=10)
+    >>> c.set('a', 'x' * 6)
+    >>> c.set('b', 'y' * 6)
+    >>> c.get('a') is None, c.get('b')
+    (True, 'yyyyyy')
+    >>> c.stats()['bytes']
+    6
+    '''
+
+    def __init__(self, ttl=60, max_entries=10000, max_bytes=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # key => (expires, value), least recently used first:
+        self._data = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                self._misses = self._misses + 1
+                return default
+            if item[0] and item[0] < time.time():
+                self._misses = self._misses + 1
+                self._expirations = self._expirations + 1
+                self._forget(item)
+                return default
+            self._data[key] = item
+            self._hits = self._hits + 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl else 0
+        with self._lock:
+            self._forget(self._data.pop(key, None))
+            self._data[key] = (expires, value)
+            if self.max_bytes is not None:
+                self._bytes = self._bytes + len(value)
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes and len(self._data) > 1):
+                self._forget(self._data.popitem(last=False)[1])
+                self._evictions = self._evictions + 1
+
+    def _forget(self, item):
+        if item is not None and self.max_bytes is not None:
+            self._bytes = self._bytes - len(item[1])
+
+    def delete(self, key):
+        with self._lock:
+            self._forget(self._data.pop(key, None))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self._hits, misses=self._misses, evictions=self._evictions, \
+                    expirations=self._expirations, size=len(self._data), max_entries=self.max_entries, bytes=self._bytes)
+
+
+def create_cache(config):
+    '''
+    Create a store from a config dict like dict(ttl=60, max_entries=100000).
+    A CacheBackend instance passed as config['backend'] is returned as is.
+    '''
+    if isinstance(config, CacheBackend):
+        return config
+    config = dict(config)
+    backend = config.pop('backend', None)
+    if backend is not None:
+        return backend
+    return LocalCache(**config)
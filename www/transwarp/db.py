@@ -13,7 +13,10 @@ import threading
 import logging
 import collections
 import os
+import re
 import datetime
+import operator
+import itertools
 
 
 class Dict(dict):
@@ -32,6 +35,96 @@ class Dict(dict):
         self[key] = value
 
 
+class Row(tuple):
+    '''
+    Base class of tuple-backed rows. Subclasses are generated once per column
+    signature by row_type(), and support access as row.x, row['x'] and row[0].
+    Like sqlite3.Row, iterating a row yields its values.
+
+    >>> User = row_type(['id', 'name'])
+    >>> u = User((1, 'Bob'))
+    >>> u.name, u['id'], u[1]
+    ('Bob', 1, 'Bob')
+    >>> u.keys()
+    ['id', 'name']
+    >>> dict(u.items()) == dict(id=1, name='Bob')
+    True
+    >>> row_type(('id', 'name')) is User
+    True
+    '''
+
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                return tuple.__getitem__(self, self._index[key])
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % kv for kv in self.items())
+
+
+_RE_IDENTIFIER = re.compile(r'^[a-zA-Z_]\w*$')
+_row_types = {}
+_row_types_lock = threading.Lock()
+_ROW_TYPES_SIZE = 1024
+
+
+def row_type(names):
+    '''
+    Return the Row subclass for the column names, created once and cached.
+    '''
+    names = tuple(names)
+    cls = _row_types.get(names)
+    if cls is None:
+        attrs = dict(__slots__=(), _fields=names, _index=dict((n, i) for i, n in enumerate(names)))
+        for i, n in enumerate(names):
+            # columns like 'count(id)' or 'keys' are still reachable by row['...']:
+            if _RE_IDENTIFIER.match(n) and not hasattr(Row, n):
+                attrs[str(n)] = property(operator.itemgetter(i))
+        cls = type('Row', (Row, ), attrs)
+        with _row_types_lock:
+            if len(_row_types) >= _ROW_TYPES_SIZE:
+                _row_types.clear()
+            cls = _row_types.setdefault(names, cls)
+    return cls
+
+
+def dict_row(names):
+    '''
+    Row factory that makes a Dict per row. This is the default.
+    '''
+    return lambda values: Dict(names, values)
+
+
+def tuple_row(names):
+    '''
+    Row factory that makes a compact Row per row, see row_type().
+    '''
+    return row_type(names)
+
+
 class DBError(Exception):
     pass
 
@@ -55,15 +148,64 @@ def next_id(t=None):
 
 class _LasyConnection(object):
 
-    def __init__(self):
+    def __init__(self, read_only=False):
         self.connection = None
+        self.read_only = read_only
+        # the _Replica the connection comes from:
+        self.replica = None
 
-    def cursor(self):
+    def _connect(self):
         if self.connection is None:
             connection = engine.connect()
-            logging.info('open connection <%s>...' % hex(id(connection)))
+            logging.info('checkout connection <%s>...' % hex(id(connection)))
             self.connection = connection
-        return self.connection.cursor()
+        return self.connection
+
+    def open_replica(self):
+        '''
+        Check out a connection from a healthy replica, return False if there is none.
+        '''
+        if self.connection is not None:
+            return True
+        replica = engine.replica()
+        if replica is None:
+            return False
+        try:
+            connection = replica.pool.checkout()
+        except PoolTimeoutError:
+            return False
+        except Exception:
+            logging.warning('connect to replica %s failed.' % replica.name)
+            engine.eject(replica)
+            return False
+        logging.info('checkout replica %s connection <%s>...' % (replica.name, hex(id(connection))))
+        self.connection = connection
+        self.replica = replica
+        return True
+
+    def discard_if_dead(self):
+        '''
+        After a failed query on a replica, eject the replica and drop the
+        connection if the server is gone. Return True if so.
+        '''
+        if self.replica is None or self.connection is None or self.connection.ping():
+            return False
+        engine.eject(self.replica)
+        connection, replica = self.connection, self.replica
+        self.connection = None
+        self.replica = None
+        replica.pool._discard(connection)
+        return True
+
+    def cursor(self):
+        return self._connect().cursor()
+
+    def prepared(self, sql):
+        return self._connect().prepared(sql)
+
+    def unprepare(self, sql):
+        if self.connection:
+            self.connection.unprepare(sql)
 
     def commit(self):
         self.connection.commit()
@@ -74,8 +216,14 @@ class _LasyConnection(object):
     def cleanup(self):
         if self.connection:
             connection = self.connection
-            logging.info('close connection <%s>...' % hex(id(connection)))
-            connection.close()
+            replica = self.replica
+            self.connection = None
+            self.replica = None
+            logging.info('release connection <%s>...' % hex(id(connection)))
+            if replica:
+                replica.pool.checkin(connection)
+            else:
+                engine.release(connection)
 
 
 class _DbCtx(threading.local):
@@ -85,7 +233,12 @@ class _DbCtx(threading.local):
 
     def __init__(self):
         self.connection = None
+        self.replica = None
         self.transactions = 0
+        self.cache = None
+        self.wrote_at = None
+        # functions to call once the current transaction commits:
+        self.after_commit = []
 
     def is_init(self):
         return not self.connection is None
@@ -93,11 +246,21 @@ class _DbCtx(threading.local):
     def init(self):
         logging.info('open lazy connection...')
         self.connection = _LasyConnection()
+        self.replica = _LasyConnection(read_only=True)
         self.transactions = 0
+        self.cache = {}
+        self.wrote_at = None
+        self.after_commit = []
 
     def cleanup(self):
-        self.connection.cleanup()
-        self.connection = None
+        try:
+            self.replica.cleanup()
+        finally:
+            self.connection.cleanup()
+            self.connection = None
+            self.replica = None
+            self.cache = None
+            self.after_commit = []
 
     def cursor(self):
         '''
@@ -112,32 +275,470 @@ _db_ctx = _DbCtx()
 engine = None
 
 
+class PoolTimeoutError(DBError):
+    pass
+
+
+class _PooledConnection(object):
+    '''
+    Wrap a raw connection with the bookkeeping the pool needs, and a LRU
+    of server-side prepared statements keyed by the original '?'-style SQL.
+    '''
+
+    def __init__(self, raw, max_statements=0):
+        self.raw = raw
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.max_statements = max_statements
+        self.statements = collections.OrderedDict()
+
+    def cursor(self, **kw):
+        return self.raw.cursor(**kw)
+
+    def prepared(self, sql):
+        '''
+        Return (sql, cursor) where cursor is a prepared cursor owned by this
+        connection, or None if the statement cache is disabled. Always execute
+        the returned sql object: the driver only skips re-preparing when it sees
+        the same statement again.
+
+        Connections are opened with buffered=True, but mysql.connector has no
+        cursor that is both buffered and prepared, so ask for an unbuffered one:
+
+        >>> class FakeRaw(object):
+        ...     def cursor(self, **kw):
+        ...         return sorted(kw.items())
+        >>> _PooledConnection(FakeRaw(), max_statements=1).prepared('select ?')
+        ('select ?', [('buffered', False), ('prepared', True)])
+        '''
+        if not self.max_statements:
+            return None
+        stmt = self.statements.pop(sql, None)
+        if stmt is None:
+            if len(self.statements) >= self.max_statements:
+                old_sql, old = self.statements.popitem(last=False)
+                logging.info('evict prepared statement: %s' % old_sql)
+                self._close_cursor(old[1])
+            stmt = (sql, self.raw.cursor(prepared=True, buffered=False))
+        self.statements[sql] = stmt
+        return stmt
+
+    def unprepare(self, sql):
+        stmt = self.statements.pop(sql, None)
+        if stmt:
+            self._close_cursor(stmt[1])
+
+    def _close_cursor(self, cursor):
+        try:
+            cursor.close()
+        except Exception:
+            logging.warning('close prepared statement failed.')
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def ping(self):
+        '''
+        Return True if the server still answers on this connection.
+        '''
+        try:
+            self.raw.ping()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        for sql, cursor in self.statements.itervalues():
+            self._close_cursor(cursor)
+        self.statements.clear()
+        try:
+            self.raw.close()
+        except Exception:
+            logging.warning('close connection <%s> failed.' % hex(id(self)))
+
+
+class _ConnectionPool(object):
+    '''
+    Bounded, thread-safe pool of connections created by connect().
+
+    Args:
+        connect: function that returns a new raw connection.
+        min_size: connections kept open even when idle, default to 0.
+        max_size: max connections open at the same time, default to 10.
+        timeout: seconds to wait for a free connection before raising PoolTimeoutError.
+        max_idle: seconds an idle connection (above min_size) is kept before it is closed.
+        max_lifetime: seconds after which a connection is closed instead of reused.
+        ping_interval: ping a connection on checkout if it has been idle longer than this.
+        statement_cache_size: prepared statements cached per connection, 0 to disable.
+
+    >>> class FakeConnection(object):
+    ...     def ping(self): pass
+    ...     def rollback(self): pass
+    ...     def close(self): pass
+    >>> pool = _ConnectionPool(FakeConnection, max_size=1, timeout=0.01)
+    >>> c1 = pool.checkout()
+    >>> pool.checkout()
+    Traceback (most recent call last):
+      ...
+    PoolTimeoutError: No free connection in 0.01 seconds.
+    >>> pool.checkin(c1)
+    >>> pool.checkout() is c1
+    True
+    >>> st = pool.stats()
+    >>> st.size, st.idle, st.checkouts, st.timeouts
+    (1, 0, 2, 1)
+    '''
+
+    def __init__(self, connect, min_size=0, max_size=10, timeout=30.0, max_idle=300.0, max_lifetime=3600.0, ping_interval=5.0, statement_cache_size=0):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('Invalid pool size: min_size=%s, max_size=%s' % (min_size, max_size))
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.statement_cache_size = statement_cache_size
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = collections.deque()
+        self._size = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._closed = 0
+        self._wait_time = 0.0
+
+    def _expired(self, conn, now):
+        return self.max_lifetime and now - conn.created_at > self.max_lifetime
+
+    def _open(self):
+        conn = _PooledConnection(self._connect(), self.statement_cache_size)
+        with self._cond:
+            self._created = self._created + 1
+        logging.info('pool open connection <%s>...' % hex(id(conn)))
+        return conn
+
+    def _discard(self, conn):
+        '''
+        Close conn and free its slot. Must be called without holding the lock.
+        '''
+        conn.close()
+        with self._cond:
+            self._size = self._size - 1
+            self._closed = self._closed + 1
+            self._cond.notify()
+
+    def checkout(self):
+        start = time.time()
+        deadline = start + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._timeouts = self._timeouts + 1
+                        raise PoolTimeoutError('No free connection in %s seconds.' % self.timeout)
+                    self._waiting = self._waiting + 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting = self._waiting - 1
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    # reserve the slot before connecting outside the lock:
+                    self._size = self._size + 1
+            if conn is None:
+                try:
+                    conn = self._open()
+                except:
+                    with self._cond:
+                        self._size = self._size - 1
+                        self._cond.notify()
+                    raise
+            else:
+                now = time.time()
+                if self._expired(conn, now):
+                    self._discard(conn)
+                    continue
+                if now - conn.last_used > self.ping_interval and not conn.ping():
+                    logging.warning('connection <%s> is dead, discard it.' % hex(id(conn)))
+                    self._discard(conn)
+                    continue
+            with self._cond:
+                self._checkouts = self._checkouts + 1
+                self._wait_time = self._wait_time + (time.time() - start)
+            return conn
+
+    def checkin(self, conn):
+        now = time.time()
+        try:
+            # end the implicit transaction so the next user does not see a stale snapshot:
+            conn.rollback()
+        except Exception:
+            logging.warning('rollback on release failed, discard connection <%s>.' % hex(id(conn)))
+            self._discard(conn)
+            return
+        if self._expired(conn, now):
+            self._discard(conn)
+            return
+        conn.last_used = now
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+        self._reap(now)
+
+    def _reap(self, now):
+        '''
+        Close connections idle longer than max_idle, keeping at least min_size open.
+        '''
+        if not self.max_idle:
+            return
+        L = []
+        with self._cond:
+            # the oldest idle connections are at the left end:
+            while self._idle and self._size - len(L) > self.min_size and now - self._idle[0].last_used > self.max_idle:
+                L.append(self._idle.popleft())
+        for conn in L:
+            self._discard(conn)
+
+    def close(self):
+        with self._cond:
+            L = list(self._idle)
+            self._idle.clear()
+        for conn in L:
+            self._discard(conn)
+
+    def reset(self):
+        '''
+        Forget all connections without closing them, in a forked child where
+        they still belong to the parent. The lock is replaced, another thread
+        of the parent may have held it at fork time.
+        '''
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = collections.deque()
+        self._size = 0
+        self._waiting = 0
+
+    def stats(self):
+        '''
+        Return pool counters as a Dict.
+        '''
+        with self._cond:
+            return Dict(size=self._size, idle=len(self._idle), in_use=self._size - len(self._idle), \
+                    waiting=self._waiting, min_size=self.min_size, max_size=self.max_size, \
+                    checkouts=self._checkouts, timeouts=self._timeouts, created=self._created, \
+                    closed=self._closed, wait_time=self._wait_time)
+
+
+class _Replica(object):
+    '''
+    A read-only endpoint with its own pool, left out of routing while ejected.
+    '''
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.ejected_until = 0.0
+        self.failures = 0
+
+
 class _Engine(object):
+    '''
+    The primary pool, and replica pools that reads outside transactions go to.
+
+    >>> class FakeConnection(object):
+    ...     def ping(self): pass
+    ...     def rollback(self): pass
+    ...     def close(self): pass
+    >>> e = _Engine(FakeConnection, replicas=[('r1', FakeConnection), ('r2', FakeConnection)], check_interval=0)
+    >>> [e.replica().name for i in range(3)]
+    ['r1', 'r2', 'r1']
+    >>> e.eject(e.replicas[0])
+    >>> [e.replica().name for i in range(2)]
+    ['r2', 'r2']
+    >>> e.eject(e.replicas[1])
+    >>> e.replica() is None
+    True
+    '''
 
-    def __init__(self, connect):
+    def __init__(self, connect, replicas=(), policy='round_robin', eject_time=30.0, check_interval=5.0, read_your_writes=None, **kw):
+        if policy not in ('round_robin', 'least_loaded'):
+            raise ValueError('Invalid replica policy: %s' % policy)
         self._connect = connect  # connect is a anonymous function
+        self.pool = _ConnectionPool(connect, **kw)
+        self.replicas = [_Replica(name, _ConnectionPool(c, **kw)) for name, c in replicas]
+        self.policy = policy
+        self.eject_time = eject_time
+        self.check_interval = check_interval
+        self.read_your_writes = read_your_writes
+        self._next = itertools.count()
+        self._start_checker()
+
+    def _start_checker(self):
+        if self.replicas and self.check_interval:
+            t = threading.Thread(target=self._check_replicas, name='transwarp-db-replicas')
+            t.daemon = True
+            t.start()
+
+    def reset_after_fork(self):
+        '''
+        Drop the pooled connections inherited from the parent process and
+        start the replica health check, which does not survive a fork.
+        '''
+        for pool in [self.pool] + [r.pool for r in self.replicas]:
+            pool.reset()
+        self._start_checker()
 
     def connect(self):
-        return self._connect()  # what's the intension _connect() ?
+        return self.pool.checkout()
+
+    def release(self, connection):
+        self.pool.checkin(connection)
+
+    def replica(self):
+        '''
+        Return the _Replica to read from next, None if all are ejected.
+        '''
+        now = time.time()
+        L = [r for r in self.replicas if r.ejected_until <= now]
+        if not L:
+            return None
+        if self.policy == 'least_loaded':
+            return min(L, key=lambda r: r.pool.stats().in_use)
+        return L[self._next.next() % len(L)]
+
+    def eject(self, replica):
+        replica.failures = replica.failures + 1
+        replica.ejected_until = time.time() + self.eject_time
+        logging.warning('replica %s failed, eject it for %s seconds.' % (replica.name, self.eject_time))
+
+    def _check_replicas(self):
+        while True:
+            time.sleep(self.check_interval)
+            for replica in self.replicas:
+                self._check(replica)
+
+    def _check(self, replica):
+        try:
+            conn = replica.pool.checkout()
+        except PoolTimeoutError:
+            # all connections busy, the replica is alive:
+            return
+        except Exception:
+            self.eject(replica)
+            return
+        alive = conn.ping()
+        if alive:
+            replica.pool.checkin(conn)
+        else:
+            replica.pool._discard(conn)
+        if not alive:
+            self.eject(replica)
+        elif replica.ejected_until:
+            logging.info('replica %s is back.' % replica.name)
+            replica.ejected_until = 0.0
+
+    def stats(self):
+        st = self.pool.stats()
+        if self.replicas:
+            now = time.time()
+            st.replicas = []
+            for r in self.replicas:
+                rs = r.pool.stats()
+                rs.name = r.name
+                rs.ejected = r.ejected_until > now
+                rs.failures = r.failures
+                st.replicas.append(rs)
+        return st
+
+
+_REPLICA_ARGS = dict(replica_policy='policy', replica_eject_time='eject_time', \
+        replica_check_interval='check_interval', read_your_writes='read_your_writes')
+
+_POOL_ARGS = dict(pool_min_size='min_size', pool_max_size='max_size', pool_timeout='timeout', \
+        pool_max_idle='max_idle', pool_max_lifetime='max_lifetime', pool_ping_interval='ping_interval', \
+        statement_cache_size='statement_cache_size')
 
 
 def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+    '''
+    Init the global engine. Connections are pooled, the pool can be tuned by passing
+    pool_min_size, pool_max_size, pool_timeout, pool_max_idle, pool_max_lifetime
+    and pool_ping_interval. statement_cache_size sets how many prepared statements
+    each pooled connection keeps (default to 64, 0 to disable).
+
+    replicas is a list of read replicas, each a dict of connection args that
+    override the primary ones, like dict(host='10.0.0.2'), or a 'host:port'
+    string. Each gets its own pool. Selects outside a transaction go to a
+    replica picked by replica_policy, 'round_robin' (default) or
+    'least_loaded', unless the same connection context has written. Then
+    reads stay on the primary, for read_your_writes seconds or, by default,
+    until the context ends. A replica failing a connect, a health check
+    every replica_check_interval seconds, or a query with a dead connection
+    is ejected for replica_eject_time seconds.
+
+    A process forked after this must call reset_after_fork() before its
+    first query.
+
+    All other keyword args are passed to mysql.connector.
+    '''
     import mysql.connector
     global engine
     if engine is not None:
         raise DBError('Engine is already initialized.')
+    pool_kw = dict(statement_cache_size=64)
+    for k, v in _POOL_ARGS.iteritems():
+        if k in kw:
+            pool_kw[v] = kw.pop(k)
+    for k, v in _REPLICA_ARGS.iteritems():
+        if k in kw:
+            pool_kw[v] = kw.pop(k)
+    replicas = kw.pop('replicas', None) or ()
     params = dict(user=user, password=password, database=database, host=host, port=port)
     defaults = dict(charset='utf8', collation='utf8_general_ci', autocommit=False)
     for k, v in defaults.iteritems():
         params[k] = kw.pop(k, v)
     params.update(kw)
     params['buffered'] = True
+    L = []
+    for r in replicas:
+        if isinstance(r, basestring):
+            h, sep, p = r.partition(':')
+            r = dict(host=h, port=int(p)) if sep else dict(host=h)
+        r_params = dict(params, **r)
+        L.append(('%s:%s' % (r_params['host'], r_params['port']), functools.partial(mysql.connector.connect, **r_params)))
     #  why lamada ?
-    engine = _Engine(lambda: mysql.connector.connect(**params))
+    engine = _Engine(lambda: mysql.connector.connect(**params), replicas=L, **pool_kw)
     # test connection
     logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
 
 
+def reset_after_fork():
+    '''
+    Call in a process forked after create_engine(), e.g. a prefork worker,
+    so it opens its own connections instead of sharing the parent's sockets.
+    '''
+    if engine is not None:
+        engine.reset_after_fork()
+
+
+def pool_stats():
+    '''
+    Return counters of the connection pool, such as size, idle, checkouts and
+    wait_time, with the same for each replica in a replicas list if any.
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    return engine.stats()
+
+
 class _ConnectionCtx(object):
     '''
     '''
@@ -162,6 +763,40 @@ def connection():
     return _ConnectionCtx()
 
 
+def context_cache():
+    '''
+    Return a dict that lives as long as the current connection context and is
+    cleared on rollback, or None if no connection context is open.
+    '''
+    global _db_ctx
+    return _db_ctx.cache
+
+
+def in_transaction():
+    '''
+    Return True inside a transaction, where reads may see uncommitted rows.
+    '''
+    global _db_ctx
+    return _db_ctx.is_init() and _db_ctx.transactions > 0
+
+
+def after_commit(fn):
+    '''
+    Call fn() once the current transaction commits, or at once outside a
+    transaction. fn is dropped if the transaction rolls back.
+
+    >>> calls = []
+    >>> after_commit(lambda: calls.append(1))
+    >>> calls
+    [1]
+    '''
+    global _db_ctx
+    if in_transaction():
+        _db_ctx.after_commit.append(fn)
+    else:
+        fn()
+
+
 def with_connection(func):
     '''
     Decorator for reuse connection
@@ -193,7 +828,7 @@ class _TransactionCtx(object):
         logging.info('begin transaction...' if _db_ctx.transactions == 1 else 'join current transation...')
         return self
 
-    def __exit(self, exctype, excvalue, traceback):
+    def __exit__(self, exctype, excvalue, traceback):
         global _db_ctx
         _db_ctx.transactions = _db_ctx.transactions - 1
         try:
@@ -210,18 +845,25 @@ class _TransactionCtx(object):
         global _db_ctx
         logging.info('commit transaction...')
 
+        callbacks = _db_ctx.after_commit
+        _db_ctx.after_commit = []
         try:
             _db_ctx.connection.commit()
             logging.info('commit ok')
         except:
             logging.warning('commit failed. try rollback...')
+            _db_ctx.cache.clear()
             _db_ctx.connection.rollback()
             logging.warning('rollback ok')
             raise
+        for fn in callbacks:
+            fn()
 
     def rollback(self):
         global _db_ctx
         logging.warning('rollback transaction...')
+        _db_ctx.cache.clear()
+        _db_ctx.after_commit = []
         _db_ctx.connection.rollback()
         logging.info('rollback ok ok ok.')
 
@@ -253,33 +895,124 @@ def with_transaction(func):
     return _wrapper
 
 
-def _select(sql, first, *args):
+# cache of '?'-style SQL rewritten to the '%s' paramstyle of mysql.connector:
+_format_cache = {}
+_FORMAT_CACHE_SIZE = 1024
+
+_PREPARABLE = ('select', 'insert', 'update', 'delete', 'replace')
+
+
+def _format_sql(sql):
+    '''
+    Convert '?' placeholders to '%s', caching the result by SQL text.
+
+    >>> _format_sql('select * from users where id=?')
+    'select * from users where id=%s'
+    '''
+    s = _format_cache.get(sql)
+    if s is None:
+        s = sql.replace('?', '%s')
+        if len(_format_cache) < _FORMAT_CACHE_SIZE:
+            _format_cache[sql] = s
+    return s
+
+
+def _execute(sql, args, connection=None):
+    '''
+    Execute sql on connection, default to the current primary connection,
+    and return (cursor, cached). A cached cursor is a prepared statement
+    owned by the connection and must not be closed by the caller.
+    '''
+    global _db_ctx
+    if connection is None:
+        connection = _db_ctx.connection
+    if args and sql.lstrip()[:7].lower().startswith(_PREPARABLE):
+        stmt = connection.prepared(sql)
+        if stmt:
+            sql, cursor = stmt
+            try:
+                cursor.execute(sql, args)
+            except:
+                connection.unprepare(sql)
+                raise
+            return cursor, True
+    cursor = connection.cursor()
+    try:
+        cursor.execute(_format_sql(sql), args)
+    except:
+        cursor.close()
+        raise
+    return cursor, False
+
+
+def _wrote_recently():
+    global _db_ctx
+    if _db_ctx.wrote_at is None:
+        return False
+    return engine.read_your_writes is None or time.time() - _db_ctx.wrote_at < engine.read_your_writes
+
+
+def _read_connection(primary=False):
+    '''
+    Return the connection to read from: a replica outside transactions and
+    after no recent write in this context, otherwise the primary.
+    '''
+    global _db_ctx
+    if primary or not engine.replicas or _db_ctx.transactions or _wrote_recently() or not _db_ctx.replica.open_replica():
+        return _db_ctx.connection
+    return _db_ctx.replica
+
+
+def _select(sql, first, factory, *args, **kw):
     'execute select SQL and return unique result or list results.'
     global _db_ctx
+    connection = _read_connection(kw.pop('primary', False))
+    try:
+        return _select_on(connection, sql, first, factory, args)
+    except Exception:
+        if connection is _db_ctx.connection or not connection.discard_if_dead():
+            raise
+        logging.warning('replica query failed, read from primary.')
+        return _select_on(_db_ctx.connection, sql, first, factory, args)
+
+
+def _select_on(connection, sql, first, factory, args):
     cursor = None
-    sql = sql.replace('?', '%s')
+    cached = False
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        cursor, cached = _execute(sql, args, connection)
         if cursor.description:
-            names = [x[0] for x in cursor.description]
+            make_row = factory([x[0] for x in cursor.description])
         if first:
             values = cursor.fetchone()
+            if cached:
+                # prepared cursors are unbuffered, drain them before reuse:
+                cursor.fetchall()
             if not values:
                 return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            return make_row(values)
+        return map(make_row, cursor.fetchall())
     finally:
-        if cursor:
+        if cursor and not cached:
             cursor.close()
 
 
+def _pop_factory(kw):
+    factory = kw.pop('factory', dict_row)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+    return factory
+
+
 @with_connection
-def select_one(sql, *args):
+def select_one(sql, *args, **kw):
     '''
+    Execute select SQL and return the first row or None. Pass factory=tuple_row
+    to get a compact Row instead of a Dict, and primary=True to skip replicas.
     '''
-    return _select(sql, True, *args)
+    primary = kw.pop('primary', False)
+    return _select(sql, True, _pop_factory(kw), *args, primary=primary)
 
 
 @with_connection
@@ -287,38 +1020,106 @@ def select_int(sql, *args):
     '''
     Execute select SQL and expected only one int result
     '''
-    d = _select(sql, True, *args)
+    d = _select(sql, True, tuple_row, *args)
     if len(d) != 1:
         raise MultiColumnsError('Expect only one column')
-    return d.values()[0]
+    return d[0]
 
 
 @with_connection
-def select(sql, *args):
-    return _select(sql, False, *args)
+def select(sql, *args, **kw):
+    '''
+    Execute select SQL and return a list of rows. Pass factory=tuple_row
+    to get compact Row objects instead of Dicts, and primary=True to skip replicas.
+    '''
+    primary = kw.pop('primary', False)
+    return _select(sql, False, _pop_factory(kw), *args, primary=primary)
 
 
 @with_connection
 def _update(sql, *args):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
+    cached = False
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
     try:
-        cursor = _db_ctx.connection.cursor()  
-        print sql, args
-        cursor.execute(sql, args)
+        cursor, cached = _execute(sql, args)
         r = cursor.rowcount
-        print _db_ctx.transactions
+        _db_ctx.wrote_at = time.time()
         if _db_ctx.transactions == 0:
             logging.info('auto commit')
             _db_ctx.connection.commit()
         return r
     finally:
-        if cursor:
+        if cursor and not cached:
             cursor.close()
 
 
+def iter_select(sql, *args, **kw):
+    '''
+    Execute select SQL and yield rows one by one from an unbuffered cursor,
+    fetching batch_size (default to 1000) rows from the server at a time.
+    factory works like in select().
+
+    The generator checks out its own connection from the pool on the first
+    next(), so it does not see uncommitted changes of the current transaction
+    and may be interleaved with other queries. The connection goes back to the
+    pool when exhausted, and is discarded when the generator is closed early
+    or fails. With replicas it reads from one, unless the current context is
+    in a transaction or has written recently.
+
+    for row in iter_select('select * from comments where blog_id=?', bid, batch_size=500):
+        pass
+    '''
+    global _db_ctx
+    batch_size = kw.pop('batch_size', 1000)
+    factory = _pop_factory(kw)
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    pool = engine.pool
+    if engine.replicas and not (_db_ctx.is_init() and (_db_ctx.transactions or _wrote_recently())):
+        replica = engine.replica()
+        if replica:
+            pool = replica.pool
+    try:
+        connection = pool.checkout()
+    except PoolTimeoutError:
+        raise
+    except Exception:
+        if pool is engine.pool:
+            raise
+        engine.eject(replica)
+        pool = engine.pool
+        connection = pool.checkout()
+    cursor = None
+    exhausted = False
+    try:
+        cursor = connection.cursor(buffered=False)
+        cursor.execute(_format_sql(sql), args)
+        make_row = factory([x[0] for x in cursor.description])
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for x in rows:
+                yield make_row(x)
+        exhausted = True
+    finally:
+        # closing early leaves unread rows: closing the cursor raises and the
+        # rollback in checkin() would read them all, so drop the connection:
+        if exhausted:
+            try:
+                cursor.close()
+            except Exception:
+                logging.warning('close unbuffered cursor failed.')
+                exhausted = False
+        if exhausted:
+            pool.checkin(connection)
+        else:
+            pool._discard(connection)
+
+
 def insert(table, **kw):
     ''' Execute insert SQL
     '''
@@ -327,6 +1128,69 @@ def insert(table, **kw):
     return _update(sql, *args)
 
 
+def _value_size(v):
+    if isinstance(v, str):
+        return len(v)
+    if isinstance(v, unicode):
+        return len(v.encode('utf-8'))
+    return len(str(v))
+
+
+def _chunk_rows(rows, cols, chunk_size, max_size):
+    '''
+    Split rows into lists of value tuples, each list at most chunk_size long
+    and with an estimated size of at most max_size bytes.
+
+    >>> rows = [dict(id=i, name='n%s' % i) for i in range(5)]
+    >>> [len(c) for c in _chunk_rows(rows, ['id', 'name'], 2, 1024)]
+    [2, 2, 1]
+    >>> [len(c) for c in _chunk_rows(rows, ['id', 'name'], 10, 20)]
+    [2, 2, 1]
+    '''
+    chunk = []
+    size = 0
+    for row in rows:
+        if len(row) != len(cols):
+            raise DBError('All rows must have the same columns.')
+        try:
+            values = tuple(row[c] for c in cols)
+        except KeyError, e:
+            raise DBError('All rows must have the same columns, missing %s.' % e)
+        # each value costs its data plus a placeholder and separator:
+        row_size = sum(_value_size(v) + 2 for v in values) + 2
+        if chunk and (len(chunk) >= chunk_size or size + row_size > max_size):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(values)
+        size = size + row_size
+    if chunk:
+        yield chunk
+
+
+def insert_many(table, rows, chunk_size=500, max_packet_size=1048576):
+    '''
+    Execute multi-row insert SQL for rows, a list of dicts with the same keys.
+
+    Rows are sent as 'insert ... values (...),(...)' statements of at most
+    chunk_size rows and about max_packet_size bytes each, all in one transaction.
+    Return the affected row count.
+    '''
+    if not rows:
+        return 0
+    cols = rows[0].keys()
+    head = 'insert into `%s` (%s) values ' % (table, ','.join('`%s`' % col for col in cols))
+    placeholder = '(%s)' % ','.join(['?' for i in range(len(cols))])
+    r = 0
+    with _TransactionCtx():
+        for chunk in _chunk_rows(rows, cols, chunk_size, max_packet_size - len(head)):
+            args = []
+            for values in chunk:
+                args.extend(values)
+            r = r + _update(head + ','.join([placeholder] * len(chunk)), *args)
+    return r
+
+
 def update(sql, *args):
     '''
     '''
@@ -2,9 +2,10 @@
 # -*- coding=utf-8 -*-
 
 
-import time, logging
+import time, logging, itertools, json, base64, threading
 
 import db
+from cache import create_cache
 
 
 class Field(object):
@@ -100,7 +101,7 @@ class VersionField(Field):
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'post_insert', 'post_update', 'post_delete'])
 # frozenset is immutable and hashable
 
 def _gen_sql(table_name, mappings):
@@ -119,6 +120,113 @@ def _gen_sql(table_name, mappings):
     return '\n'.join(sql)
 
 
+def encode_cursor(value, pk):
+    '''
+    Encode the sort value and primary key of a row as an opaque cursor.
+
+    >>> c = encode_cursor(1405000000.25, u'0014')
+    >>> decode_cursor(c)
+    [1405000000.25, u'0014']
+    '''
+    return base64.urlsafe_b64encode(json.dumps([value, pk]))
+
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor made by encode_cursor(), raise ValueError if it is invalid.
+
+    >>> decode_cursor('bad')
+    Traceback (most recent call last):
+      ...
+    ValueError: Invalid cursor.
+    '''
+    try:
+        L = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(L, list) or len(L) != 2:
+        raise ValueError('Invalid cursor.')
+    return L
+
+
+def _pop_fields(kw):
+    fields = kw.pop('fields', None)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+    return fields
+
+
+class _CountCache(object):
+    '''
+    Counts of one model keyed by where clause and args.
+
+    A count older than ttl is still returned, and a background thread
+    refreshes it, so only the very first count of a key hits the request path.
+
+    >>> cc = _CountCache(ttl=60)
+    >>> cc.get(None, lambda: 10)
+    10
+    >>> cc.add(1)
+    >>> cc.get(None, lambda: 0)
+    11
+    '''
+
+    def __init__(self, ttl=60, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key => [count, expires]:
+        self._data = {}
+        self._refreshing = set()
+
+    def get(self, key, load):
+        with self._lock:
+            item = self._data.get(key)
+            stale = item is not None and item[1] < time.time() and key not in self._refreshing
+            if stale:
+                self._refreshing.add(key)
+        if item is None:
+            n = load()
+            self._store(key, n)
+            return n
+        if stale:
+            t = threading.Thread(target=self._refresh, args=(key, load))
+            t.daemon = True
+            t.start()
+        return item[0]
+
+    def _store(self, key, n):
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.max_entries:
+                self._data.clear()
+            self._data[key] = [n, time.time() + self.ttl]
+
+    def _refresh(self, key, load):
+        try:
+            self._store(key, load())
+        except Exception:
+            logging.exception('refresh count failed.')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def add(self, delta):
+        '''
+        Apply delta to the count of all rows and mark filtered counts stale,
+        since there is no telling whether the changed row matches their where.
+        '''
+        with self._lock:
+            for key, item in self._data.iteritems():
+                if key is None:
+                    item[0] = item[0] + delta
+                else:
+                    item[1] = 0
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
 class ModelMetaclass(type):
     '''
     Metaclass for model objects.
@@ -164,6 +272,11 @@ class ModelMetaclass(type):
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
         attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        attrs['__projections__'] = {}
+        if attrs.get('__count_cache__'):
+            attrs['__count_store__'] = _CountCache(**attrs['__count_cache__'])
+        if attrs.get('__cache__'):
+            attrs['__cache_store__'] = create_cache(attrs['__cache__'])
         for trigger in _triggers:
             if trigger not in attrs:  # not in
                 attrs[trigger] = None
@@ -171,10 +284,39 @@ class ModelMetaclass(type):
 
 
 class Model(dict):
+    '''
+    Base class of ORM models.
+
+    Set __identity_map__ = True on a subclass to make get() return the same
+    instance for the same primary key while a db connection context is open,
+    such as one request wrapped by db.connection().
+
+    Set __cache__ = dict(ttl=60, max_entries=100000) to share get() results
+    across requests through a read-through cache, which update(), delete()
+    and insert() invalidate. Pass dict(backend=...) to use another
+    cache.CacheBackend. Writes made with raw db.update() are not seen.
+
+    Set __count_cache__ = dict(ttl=60) to keep count_all() and count_by()
+    results in memory. insert() and delete() adjust them and expired counts
+    are refreshed in the background.
+
+    Finders take fields=('id', 'name') to select only those columns, so does
+    Blog.only('id', 'name').find_all(). The other fields are deferred and
+    loaded by one query on first attribute access.
+    '''
 
     # what is a __metaclass__ ??
     __metaclass__ = ModelMetaclass
 
+    __identity_map__ = False
+    __cache__ = None
+    __cache_store__ = None
+    __count_cache__ = None
+    __count_store__ = None
+
+    # names of fields not loaded yet, set per instance by projected finders:
+    _deferred = None
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
@@ -182,47 +324,235 @@ class Model(dict):
         try:
             return self[key]
         except KeyError:
+            if self._deferred and key in self._deferred:
+                self._load_deferred()
+                return self[key]
             raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    def _load_deferred(self):
+        deferred = self._deferred
+        object.__setattr__(self, '_deferred', None)
+        pk = self.__primary_key__.name
+        r = db.select_one('select %s from `%s` where `%s`=?' % (','.join('`%s`' % f for f in deferred), self.__table__, pk), \
+                self[pk], factory=db.tuple_row)
+        if r:
+            # keep values assigned since the object was loaded:
+            for k, v in r.items():
+                self.setdefault(k, v)
+
     @classmethod
-    def get(cls, pk):
+    def _from_row(cls, row, deferred=None):
+        '''
+        Build object from a db.Row without an intermediate dict.
+        '''
+        obj = cls()
+        dict.update(obj, itertools.izip(row._fields, row))
+        if deferred:
+            object.__setattr__(obj, '_deferred', deferred)
+        return obj
+
+    @classmethod
+    def _projection(cls, fields):
+        '''
+        Return (select list, deferred field names) for fields, cached per class.
+        '''
+        if not fields:
+            return '*', None
+        key = tuple(fields)
+        p = cls.__projections__.get(key)
+        if p is None:
+            for f in fields:
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field: %s' % f)
+            pk = cls.__primary_key__.name
+            L = list(fields) if pk in fields else [pk] + list(fields)
+            p = (','.join('`%s`' % f for f in L), frozenset(cls.__mappings__) - frozenset(L))
+            cls.__projections__[key] = p
+        return p
+
+    @classmethod
+    def only(cls, *fields):
+        '''
+        Return an object with the finders of cls that select only fields.
+
+        blogs = Blog.only('id', 'name', 'summary', 'created_at').find_all()
+        '''
+        cls._projection(fields)
+        return _Projection(cls, fields)
+
+    @classmethod
+    def _identity_map(cls):
+        if not cls.__identity_map__:
+            return None
+        return db.context_cache()
+
+    def _identity_key(self):
+        return (self.__table__, getattr(self, self.__primary_key__.name))
+
+    def _remember(self):
+        m = self._identity_map()
+        if m is not None:
+            m[self._identity_key()] = self
+
+    @classmethod
+    def get(cls, pk, fields=None):
         '''
         Get by primary key
         '''
 
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        m = cls._identity_map()
+        if m is not None:
+            obj = m.get((cls.__table__, pk))
+            if obj is not None:
+                return obj
+        if fields:
+            # partial objects are not shared through the identity map or cache:
+            return cls.find_first('where `%s`=?' % cls.__primary_key__.name, pk, fields=fields)
+        obj = cls._load(pk)
+        if obj is not None and m is not None:
+            m[(cls.__table__, pk)] = obj
+        return obj
+
+    @classmethod
+    def _load(cls, pk):
+        store = cls.__cache_store__
+        # a transaction may see rows that are not committed yet, keep them out of the shared cache:
+        if store is not None and db.in_transaction():
+            store = None
+        if store is not None:
+            key = '%s:%s' % (cls.__table__, pk)
+            d = store.get(key)
+            if d is not None:
+                # each caller gets its own copy:
+                obj = cls()
+                dict.update(obj, d)
+                return obj
+        # a lagging replica could put a row back that a write just invalidated:
+        r = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk, \
+                factory=db.tuple_row, primary=store is not None)
+        if not r:
+            return None
+        obj = cls._from_row(r)
+        if store is not None:
+            store.set(key, dict(obj))
+        return obj
+
+    @classmethod
+    def cache_stats(cls):
+        '''
+        Return hit and miss counters of the read-through cache, or None if disabled.
+        '''
+        store = cls.__cache_store__
+        return store.stats() if store is not None else None
+
+    def _invalidate(self):
+        store = self.__cache_store__
+        if store is not None:
+            key = '%s:%s' % (self.__table__, getattr(self, self.__primary_key__.name))
+            store.delete(key)
+            # another thread may cache the old row until the transaction commits:
+            db.after_commit(lambda: store.delete(key))
 
     @classmethod
-    def find_first(cls, where, *args):
+    def find_first(cls, where, *args, **kw):
         '''
         '''
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        cols, deferred = cls._projection(_pop_fields(kw))
+        r = db.select_one('select %s from %s %s' % (cols, cls.__table__, where), *args, factory=db.tuple_row)
+        return cls._from_row(r, deferred) if r else None
 
     @classmethod
-    def find_all(cls, *args):
+    def find_all(cls, *args, **kw):
         '''
         '''
-        L = db.select('select * from `%s`' % cls.__table__)
+        cols, deferred = cls._projection(_pop_fields(kw))
+        L = db.select('select %s from `%s`' % (cols, cls.__table__), factory=db.tuple_row)
+
+        return [cls._from_row(r, deferred) for r in L]
 
-        return [cls(**d) for d in L]
+    @classmethod
+    def find_by(cls, where, *args, **kw):
+        cols, deferred = cls._projection(_pop_fields(kw))
+        L = db.select('select %s from `%s` %s' % (cols, cls.__table__, where), *args, factory=db.tuple_row)
+        return [cls._from_row(r, deferred) for r in L]
 
     @classmethod
-    def find_by(cls, where, *args):
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+    def iter_by(cls, where, *args, **kw):
+        '''
+        Like find_by() but yield objects from a streaming cursor, see db.iter_select().
+        '''
+        cols, deferred = cls._projection(kw.pop('fields', None))
+        kw['factory'] = db.tuple_row
+        for r in db.iter_select('select %s from `%s` %s' % (cols, cls.__table__, where), *args, **kw):
+            yield cls._from_row(r, deferred)
+
+    @classmethod
+    def find_page(cls, order_by='created_at', after=None, before=None, limit=10, desc=True, where=None, args=()):
+        '''
+        Keyset pagination: return a db.Dict with objects, next and prev, where next
+        and prev are opaque cursors to pass back as after= or before=, or None
+        if there is no such page.
+
+        Rows are ordered by (order_by, primary key) and located with a range
+        condition instead of an offset, so every page costs the same given an
+        index on (order_by, primary key). where is an extra condition without
+        the 'where' keyword, e.g. where='user_id=?', args=(uid, ).
+        '''
+        if order_by not in cls.__mappings__:
+            raise ValueError('Invalid order_by field: %s' % order_by)
+        if after and before:
+            raise ValueError('Cannot page both after and before a cursor.')
+        pk = cls.__primary_key__.name
+        conds = [where] if where else []
+        params = list(args)
+        cursor = after or before
+        # walking backward reverses the order, the page is flipped back below:
+        backward = before is not None
+        older = desc != backward
+        if cursor:
+            value, key = decode_cursor(cursor)
+            op = '<' if older else '>'
+            conds.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (order_by, op, order_by, pk, op))
+            params.extend([value, value, key])
+        direction = 'desc' if older else 'asc'
+        sql = 'select * from `%s` %s order by `%s` %s, `%s` %s limit ?' % (cls.__table__, \
+                'where %s' % ' and '.join(conds) if conds else '', order_by, direction, pk, direction)
+        params.append(limit + 1)
+        L = map(cls._from_row, db.select(sql, *params, factory=db.tuple_row))
+        more = len(L) > limit
+        L = L[:limit]
+        if backward:
+            L.reverse()
+        first = encode_cursor(L[0][order_by], L[0][pk]) if L else None
+        last = encode_cursor(L[-1][order_by], L[-1][pk]) if L else None
+        if backward:
+            return db.Dict(objects=L, next=last, prev=first if more else None)
+        return db.Dict(objects=L, next=last if more else None, prev=first if after else None)
 
     @classmethod
     def count_all(cls):
+        store = cls.__count_store__
+        if store is not None:
+            return store.get(None, cls._count_all)
+        return cls._count_all()
+
+    @classmethod
+    def _count_all(cls):
         return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
 
     @classmethod
     def count_by(cls, where, *args):
-        return db.select_int('select_int count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+        store = cls.__count_store__
+        if store is not None:
+            return store.get((where, args), lambda: cls._count_by(where, *args))
+        return cls._count_by(where, *args)
+
+    @classmethod
+    def _count_by(cls, where, *args):
+        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
 
     def update(self):
         self.pre_update and self.pre_update()
@@ -240,16 +570,27 @@ class Model(dict):
         pk = self.__primary_key__.name
         args.append(getattr(self, pk))
         db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        self._invalidate()
+        self._remember()
+        self.post_update and self.post_update()
         return self
 
     def delete(self):
         self.pre_delete and self.pre_delete()
         pk = self.__primary_key__.name
         args = (getattr(self, pk), )
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        n = db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        self._invalidate()
+        if n and self.__count_store__ is not None:
+            store = self.__count_store__
+            db.after_commit(lambda: store.add(-n))
+        m = self._identity_map()
+        if m is not None:
+            m.pop(self._identity_key(), None)
+        self.post_delete and self.post_delete()
         return self
 
-    def insert(self):
+    def _insert_params(self):
         self.pre_insert and self.pre_insert()
         params = {}
         for k, v in self.__mappings__.iteritems():
@@ -257,9 +598,65 @@ class Model(dict):
                 if not hasattr(self, k):
                     setattr(self, k, v.default)
                 params[v.name] = getattr(self, k)
+        return params
+
+    def insert(self):
+        params = self._insert_params()
         db.insert('%s' % self.__table__, **params)
+        self._invalidate()
+        self._remember()
+        if self.__count_store__ is not None:
+            # a rollback must not leave the cached total off:
+            store = self.__count_store__
+            db.after_commit(lambda: store.add(1))
+        self.post_insert and self.post_insert()
         return self
 
+    @classmethod
+    def insert_batch(cls, objs, chunk_size=500):
+        '''
+        Insert objs with multi-row insert SQL in one transaction,
+        applying defaults and pre_insert/post_insert triggers like insert().
+        '''
+        rows = [obj._insert_params() for obj in objs]
+        db.insert_many(cls.__table__, rows, chunk_size=chunk_size)
+        for obj in objs:
+            obj._invalidate()
+            obj._remember()
+        if objs and cls.__count_store__ is not None:
+            store = cls.__count_store__
+            db.after_commit(lambda: store.add(len(objs)))
+        for obj in objs:
+            obj.post_insert and obj.post_insert()
+        return objs
+
+
+class _Projection(object):
+    '''
+    Finders of a model restricted to some fields, returned by Model.only().
+    '''
+
+    def __init__(self, cls, fields):
+        self._cls = cls
+        self._fields = fields
+
+    def get(self, pk):
+        return self._cls.get(pk, fields=self._fields)
+
+    def find_first(self, where, *args):
+        return self._cls.find_first(where, *args, fields=self._fields)
+
+    def find_all(self):
+        return self._cls.find_all(fields=self._fields)
+
+    def find_by(self, where, *args):
+        return self._cls.find_by(where, *args, fields=self._fields)
+
+    def iter_by(self, where, *args, **kw):
+        kw['fields'] = self._fields
+        return self._cls.iter_by(where, *args, **kw)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     db.create_engine('root', 'admin', 'awesome')
@@ -267,6 +664,3 @@ if __name__ == '__main__':
     db.update('create table users (id int primary key, name text, email text, passwd text, last_modified real)')
     import doctest
     doctest.testmod()
-
-
-
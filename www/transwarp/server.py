@@ -0,0 +1,1037 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+Servers to run a WSGI application in production.
+
+ThreadPoolServer accepts connections in one thread and queues them for a
+fixed pool of threads. When the queue is full a connection is answered with
+503 and Retry-After at once, so overload does not pile up in the socket
+backlog. EventLoopServer puts an epoll loop in front of the same pool to
+keep many HTTP/1.1 keep-alive connections open. serve() runs one of them in
+the current process.
+
+PreforkServer binds the listening socket once in a master process and forks
+worker processes that accept on it, each running one of them.
+
+Signals handled by the master:
+
+    SIGTERM, SIGINT: stop after the workers finish their current requests.
+    SIGHUP: replace the workers one by one, without dropping connections.
+    SIGUSR1: log the request counters of every worker.
+'''
+
+import os, sys, time, errno, fcntl, mmap, select, signal, socket, struct, logging, threading, urllib, collections, Queue
+import email.utils
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+class Dict(dict):
+    def __init__(self, names=(), values=(), **kw):
+        super(Dict, self).__init__(**kw)
+        for k, v in zip(names, values):
+            self[k] = v
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+def create_listener(host, port, backlog=128):
+    '''
+    Return a listening socket. accept() does not block, so workers woken up
+    for a connection another worker has taken just go back to wait. The
+    socket timeout is left unset since handle_request() uses it for select().
+
+    >>> s = create_listener('127.0.0.1', 0)
+    >>> s.getsockname()[1] > 0
+    True
+    >>> s.close()
+    '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, port))
+    s.listen(backlog)
+    fcntl.fcntl(s, fcntl.F_SETFL, fcntl.fcntl(s, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return s
+
+
+class _RequestHandler(WSGIRequestHandler):
+
+    def get_environ(self):
+        env = WSGIRequestHandler.get_environ(self)
+        # absolute time the response should be done by, for handlers to check:
+        env['transwarp.deadline'] = self.server.current_deadline()
+        return env
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s' % (self.address_string(), format % args))
+
+    def address_string(self):
+        # no reverse dns lookup per request:
+        return self.client_address[0]
+
+
+class _SharedServer(WSGIServer):
+    '''
+    WSGIServer accepting on a listener created by the master.
+    '''
+
+    # seconds handle_request() waits for a connection, so threads see stop():
+    timeout = 1.0
+
+    def __init__(self, listener, app):
+        WSGIServer.__init__(self, listener.getsockname(), _RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+        self.set_app(app)
+
+    def current_deadline(self):
+        return None
+
+
+_RESPONSE_503 = 'HTTP/1.0 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Type: text/plain\r\nContent-Length: 19\r\nConnection: close\r\n\r\nService Unavailable'
+
+
+class ThreadPoolServer(_SharedServer):
+    '''
+    WSGI server handing accepted connections to a fixed pool of threads.
+
+    Args:
+        threads: threads running the application, at most the db pool size
+            is useful for handlers that query the db.
+        queue_size: accepted connections waiting for a thread, more are
+            answered with 503.
+        deadline: seconds from accept a request has to complete. Requests
+            that waited longer in the queue get 503 without running, socket
+            reads and writes time out at the deadline, and handlers see it
+            as environ['transwarp.deadline'].
+        retry_after: seconds sent in the Retry-After header of a 503.
+
+    >>> def app(environ, start_response):
+    ...     start_response('200 OK', [('Content-Type', 'text/plain')])
+    ...     return ['ok']
+    >>> server = ThreadPoolServer(create_listener('127.0.0.1', 0), app, threads=1, queue_size=1)
+    >>> server.start()
+    >>> st = server.stats()
+    >>> st.threads, st.queue_size, st.queued, st.rejected
+    (1, 1, 0, 0)
+    >>> server.stop()
+    '''
+
+    def __init__(self, listener, app, threads=8, queue_size=64, deadline=30.0, retry_after=1):
+        if threads < 1 or queue_size < 1:
+            raise ValueError('Invalid pool size: threads=%s, queue_size=%s' % (threads, queue_size))
+        _SharedServer.__init__(self, listener, app)
+        self.threads = threads
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self._queue = Queue.Queue(queue_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._busy = 0
+        self._accepted = 0
+        self._served = 0
+        self._rejected = 0
+        self._expired = 0
+        self._overdue = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def start(self):
+        for i in range(self.threads):
+            t = threading.Thread(target=self._work, name='transwarp-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def stop(self, timeout=30):
+        '''
+        Let the threads finish queued requests and wait for them at most timeout seconds.
+        '''
+        deadline = time.time() + timeout
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join(max(deadline - time.time(), 0))
+        self._workers = []
+
+    def current_deadline(self):
+        return getattr(self._local, 'deadline', None)
+
+    def process_request(self, request, client_address):
+        # called by the accepting thread, must not block:
+        self._enqueue(request, client_address)
+
+    def _enqueue(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address, time.time()))
+        except Queue.Full:
+            with self._lock:
+                self._rejected = self._rejected + 1
+            self._reject(request)
+            return
+        with self._lock:
+            self._accepted = self._accepted + 1
+
+    def _reject(self, request):
+        try:
+            request.settimeout(1.0)
+            request.sendall(_RESPONSE_503 % self.retry_after)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address, accepted_at = item
+            waited = time.time() - accepted_at
+            expired = waited >= self.deadline
+            with self._lock:
+                self._wait_total = self._wait_total + waited
+                self._wait_max = max(self._wait_max, waited)
+                if expired:
+                    self._expired = self._expired + 1
+                else:
+                    self._busy = self._busy + 1
+            if expired:
+                self._reject(request)
+                continue
+            self._local.deadline = accepted_at + self.deadline
+            try:
+                self._handle(request, client_address, waited)
+            finally:
+                self._local.deadline = None
+                elapsed = time.time() - accepted_at
+                with self._lock:
+                    self._busy = self._busy - 1
+                    self._served = self._served + 1
+                    if elapsed > self.deadline:
+                        self._overdue = self._overdue + 1
+                if elapsed > self.deadline:
+                    logging.warning('request from %s took %.1f seconds, over the %s seconds deadline.' % (client_address[0], elapsed, self.deadline))
+
+    def _handle(self, request, client_address, waited):
+        try:
+            request.settimeout(self.deadline - waited)
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def stats(self):
+        '''
+        Return counters as a Dict: accepted, served, rejected (queue full),
+        expired (waited past the deadline), overdue (completed past the
+        deadline), queued, busy and wait_avg/wait_max in seconds.
+        '''
+        with self._lock:
+            dequeued = self._served + self._expired + self._busy
+            return Dict(threads=self.threads, queue_size=self.queue_size, queued=self._queue.qsize(), busy=self._busy, \
+                    accepted=self._accepted, served=self._served, rejected=self._rejected, expired=self._expired, overdue=self._overdue, \
+                    wait_avg=self._wait_total / dequeued if dequeued else 0.0, wait_max=self._wait_max)
+
+
+class _Connection(object):
+    '''
+    A client connection of the EventLoopServer.
+    '''
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        # a closed socket has no fileno(), and the number may be reused:
+        self.fd = sock.fileno()
+        self.closed = False
+        self.address = address
+        self.rbuf = ''
+        self.wbuf = ''
+        self.woffset = 0
+        # a request of this connection is in the pool:
+        self.busy = False
+        self.continued = False
+        self.close_after_write = False
+        self.last_active = time.time()
+        self.requests = 0
+        # bytes pushed by a pool thread and not sent yet:
+        self.queued = 0
+
+
+class _Job(object):
+    '''
+    A parsed request waiting for, or running in, a pool thread.
+    '''
+
+    def __init__(self, conn, environ, keep_alive):
+        self.conn = conn
+        self.environ = environ
+        self.keep_alive = keep_alive
+        # the status line went out, errors can only close the connection:
+        self.streaming = False
+
+
+def _http_head(status, headers, keep_alive, length=None):
+    '''
+    Return the status line and headers. Without a Content-Length in headers
+    or length, the body is chunked on a keep-alive connection, otherwise it
+    ends when the connection closes.
+    '''
+    L = ['HTTP/1.1 %s' % status]
+    names = set()
+    for k, v in headers:
+        names.add(k.lower())
+        L.append('%s: %s' % (k, v))
+    if 'content-length' not in names:
+        if length is not None:
+            L.append('Content-Length: %d' % length)
+        elif keep_alive:
+            L.append('Transfer-Encoding: chunked')
+    if 'date' not in names:
+        L.append('Date: %s' % email.utils.formatdate(usegmt=True))
+    L.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+    L.append('')
+    L.append('')
+    return '\r\n'.join(L)
+
+
+def _http_response(status, headers, body, keep_alive):
+    return _http_head(status, headers, keep_alive, len(body)) + body
+
+
+def _http_chunk(data):
+    return '%x\r\n%s\r\n' % (len(data), data)
+
+
+_PARSE_ERROR_RESPONSES = {
+    400: '400 Bad Request',
+    411: '411 Length Required',
+    413: '413 Request Entity Too Large',
+    431: '431 Request Header Fields Too Large',
+}
+
+
+class EventLoopServer(ThreadPoolServer):
+    '''
+    WSGI server reading and writing all connections in one thread with epoll
+    (or poll), so idle HTTP/1.1 keep-alive connections cost no thread. Complete
+    requests go to the pool of ThreadPoolServer, with the same queue, 503
+    shedding, deadline and counters, and the responses are written back by
+    the loop.
+
+    Each pool thread runs one request at a time, so ctx and the db thread
+    locals work unchanged. A body returned as a list is written at once, other
+    iterables such as streamed templates or wsgi.file_wrapper are written
+    chunk by chunk as they are produced, chunked when there is no
+    Content-Length. The pool thread waits while more than stream_buffer bytes
+    are not sent yet, and gives up on a client that reads nothing for
+    keep_alive_timeout. Chunked request bodies are refused with 411.
+
+    Args:
+        keep_alive_timeout: seconds an idle connection is kept open.
+        max_connections: open connections, more are answered with 503.
+        max_body_size: bytes of a request body, more are answered with 413.
+        stream_buffer: bytes of a streamed response queued for a client.
+        threads, queue_size, deadline, retry_after: see ThreadPoolServer.
+
+    >>> def app(environ, start_response):
+    ...     start_response('200 OK', [('Content-Type', 'text/plain')])
+    ...     return ['hello, ', environ['PATH_INFO']]
+    >>> server = EventLoopServer(create_listener('127.0.0.1', 0), app, threads=1)
+    >>> environ, keep_alive, error = server._parse('GET /a%20b?x=1 HTTP/1.1\\r\\nHost: h\\r\\nX-Id: 1\\r\\n\\r\\n', ('127.0.0.1', 1))
+    >>> environ['PATH_INFO'], environ['QUERY_STRING'], environ['HTTP_X_ID'], keep_alive, error
+    ('/a b', 'x=1', '1', True, None)
+    >>> server._parse('GET / HTTP/1.0\\r\\n\\r\\n', ('127.0.0.1', 1))[1]
+    False
+    >>> server._parse('POST / HTTP/1.1\\r\\nContent-Length: 5\\r\\n\\r\\nab', ('127.0.0.1', 1))
+    (None, True, None)
+    >>> server._parse('POST / HTTP/1.1\\r\\nTransfer-Encoding: chunked\\r\\n\\r\\n', ('127.0.0.1', 1))[2]
+    411
+    >>> server._run(_Job(_Connection(socket.socket(), None), environ, True))
+    >>> conn, r, keep_alive, last = server._done.popleft()
+    >>> r.startswith('HTTP/1.1 200 OK\\r\\n'), 'Content-Length: 11\\r\\n' in r, r.endswith('Connection: keep-alive\\r\\n\\r\\nhello, /a b')
+    (True, True, True)
+    >>> def stream_app(environ, start_response):
+    ...     start_response('200 OK', [('Content-Type', 'text/plain')])
+    ...     yield 'hello, '
+    ...     yield 'world'
+    >>> server.application = stream_app
+    >>> server._run(_Job(conn, environ, True))
+    >>> r = server._done[0][1]
+    >>> 'Transfer-Encoding: chunked\\r\\n' in r, r.endswith('\\r\\n\\r\\n7\\r\\nhello, \\r\\n')
+    (True, True)
+    >>> [(r, last) for conn, r, keep_alive, last in server._done][1:]
+    [('5\\r\\nworld\\r\\n', False), ('0\\r\\n\\r\\n', True)]
+    >>> server.server_close()
+    '''
+
+    def __init__(self, listener, app, threads=8, queue_size=64, deadline=30.0, retry_after=1, \
+            keep_alive_timeout=15, max_connections=10000, max_header_size=65536, max_body_size=10485760, \
+            stream_buffer=262144):
+        ThreadPoolServer.__init__(self, listener, app, threads, queue_size, deadline, retry_after)
+        self.keep_alive_timeout = keep_alive_timeout
+        self.stream_buffer = stream_buffer
+        self.max_connections = max_connections
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.base_environ['wsgi.multithread'] = True
+        self.base_environ['wsgi.multiprocess'] = True
+        self.base_environ['wsgi.run_once'] = False
+        self.base_environ['wsgi.url_scheme'] = 'http'
+        self.base_environ['wsgi.version'] = (1, 0)
+        self.base_environ['wsgi.errors'] = sys.stderr
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._poll = self._poller.poll
+        else:
+            self._poller = select.poll()
+            self._poll = lambda timeout: self._poller.poll(timeout * 1000)
+        # fd => _Connection:
+        self._conns = {}
+        # response pieces as (conn, data, keep_alive, last), filled by pool threads:
+        self._done = collections.deque()
+        # pool threads wait here for the loop to send what they pushed:
+        self._flow = threading.Condition()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wakeup_r, select.POLLIN)
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._keep_alive_reuses = 0
+
+    # the loop:
+
+    def serve_forever(self, poll_interval=1.0):
+        self._stopped.clear()
+        listener = self.socket.fileno()
+        self._poller.register(listener, select.POLLIN)
+        drain_until = None
+        try:
+            while True:
+                if self._stopping.is_set():
+                    if drain_until is None:
+                        self._poller.unregister(listener)
+                        drain_until = time.time() + self.deadline
+                    self._close_idle(0)
+                    if not self._conns or time.time() > drain_until:
+                        break
+                try:
+                    events = self._poll(poll_interval)
+                except (IOError, OSError, select.error), e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    if fd == listener:
+                        self._accept()
+                    elif fd == self._wakeup_r:
+                        self._finish_jobs()
+                    else:
+                        conn = self._conns.get(fd)
+                        if conn is None:
+                            continue
+                        if event & (select.POLLERR | select.POLLHUP) and not event & select.POLLIN:
+                            self._close(conn)
+                        elif event & select.POLLOUT:
+                            self._write(conn)
+                        elif event & select.POLLIN:
+                            self._read(conn)
+                self._close_idle(self.keep_alive_timeout)
+        finally:
+            for conn in self._conns.values():
+                self._close(conn)
+            self._stopped.set()
+
+    def shutdown(self):
+        '''
+        Stop accepting, let requests in progress finish and wait for the loop to exit.
+        '''
+        self._stopping.set()
+        self._wake()
+        self._stopped.wait()
+
+    def server_close(self):
+        ThreadPoolServer.server_close(self)
+        self._poller.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _wake(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    return
+                raise
+            if len(self._conns) >= self.max_connections:
+                with self._lock:
+                    self._rejected = self._rejected + 1
+                ThreadPoolServer._reject(self, sock)
+                continue
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, address)
+            self._conns[conn.fd] = conn
+            self._poller.register(conn.fd, select.POLLIN)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        if self._conns.get(conn.fd) is conn:
+            del self._conns[conn.fd]
+            self._poller.unregister(conn.fd)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        with self._flow:
+            self._flow.notify_all()
+
+    def _close_idle(self, timeout):
+        now = time.time()
+        for conn in self._conns.values():
+            if conn.busy:
+                continue
+            # a client not reading its response gets keep_alive_timeout:
+            if now - conn.last_active >= (self.keep_alive_timeout if conn.wbuf else timeout):
+                self._close(conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            return self._close(conn)
+        if not data:
+            return self._close(conn)
+        conn.rbuf = conn.rbuf + data
+        conn.last_active = time.time()
+        self._next_request(conn)
+
+    def _next_request(self, conn):
+        '''
+        Dispatch the next complete request in the read buffer, if any.
+        '''
+        if conn.busy or conn.wbuf or not conn.rbuf:
+            return
+        environ, keep_alive, error = self._parse(conn.rbuf, conn.address)
+        if error:
+            return self._send(conn, _http_response(_PARSE_ERROR_RESPONSES[error], [], '', False), False)
+        if environ is None:
+            if not conn.continued and 'expect: 100-continue' in conn.rbuf[:conn.rbuf.find('\r\n\r\n')].lower():
+                conn.continued = True
+                self._send(conn, 'HTTP/1.1 100 Continue\r\n\r\n', True)
+            return
+        conn.rbuf = conn.rbuf[environ.pop('transwarp.request_size'):]
+        conn.continued = False
+        conn.busy = True
+        conn.requests = conn.requests + 1
+        if conn.requests > 1:
+            self._keep_alive_reuses = self._keep_alive_reuses + 1
+        # no reading while the request runs, pipelined requests wait in rbuf:
+        self._poller.modify(conn.fd, 0)
+        self._enqueue(_Job(conn, environ, keep_alive), conn.address)
+
+    def _parse(self, data, address):
+        '''
+        Parse a request at the start of data. Return (environ, keep_alive, error),
+        environ is None while the request is incomplete, error a status code.
+        '''
+        end = data.find('\r\n\r\n')
+        if end < 0:
+            return None, True, 431 if len(data) > self.max_header_size else None
+        lines = data[:end].split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            return None, False, 400
+        method, target, version = parts
+        env = self.base_environ.copy()
+        for line in lines[1:]:
+            k, sep, v = line.partition(':')
+            if not sep:
+                return None, False, 400
+            k = k.strip().upper().replace('-', '_')
+            v = v.strip()
+            if k in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                env[k] = v
+                continue
+            k = 'HTTP_' + k
+            env[k] = '%s,%s' % (env[k], v) if k in env else v
+        if 'chunked' in env.get('HTTP_TRANSFER_ENCODING', '').lower():
+            return None, False, 411
+        try:
+            length = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return None, False, 400
+        if length < 0:
+            return None, False, 400
+        if length > self.max_body_size:
+            return None, False, 413
+        size = end + 4 + length
+        if len(data) < size:
+            return None, True, None
+        connection = env.get('HTTP_CONNECTION', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = 'keep-alive' in connection
+        else:
+            keep_alive = 'close' not in connection
+        if target.startswith('http://') or target.startswith('https://'):
+            target = '/' + target.split('/', 3)[3] if target.count('/') > 2 else '/'
+        path, sep, query = target.partition('?')
+        env['REQUEST_METHOD'] = method
+        env['PATH_INFO'] = urllib.unquote(path)
+        env['QUERY_STRING'] = query
+        env['SERVER_PROTOCOL'] = version
+        env['REMOTE_ADDR'] = address[0]
+        env['wsgi.input'] = StringIO(data[end + 4:size])
+        env['transwarp.request_size'] = size
+        return env, keep_alive, None
+
+    def _send(self, conn, data, keep_alive, last=True):
+        if conn.woffset:
+            conn.wbuf = conn.wbuf[conn.woffset:]
+            conn.woffset = 0
+        conn.wbuf = conn.wbuf + data
+        if last:
+            conn.close_after_write = not keep_alive
+        self._write(conn)
+
+    def _write(self, conn):
+        try:
+            n = conn.sock.send(buffer(conn.wbuf, conn.woffset))
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                n = 0
+            else:
+                return self._close(conn)
+        conn.woffset = conn.woffset + n
+        conn.last_active = time.time()
+        if n and conn.queued:
+            with self._flow:
+                conn.queued = max(0, conn.queued - n)
+                self._flow.notify_all()
+        if conn.woffset < len(conn.wbuf):
+            self._poller.modify(conn.fd, select.POLLOUT)
+            return
+        conn.wbuf = ''
+        conn.woffset = 0
+        if conn.close_after_write:
+            return self._close(conn)
+        self._poller.modify(conn.fd, 0 if conn.busy else select.POLLIN)
+        self._next_request(conn)
+
+    def _finish_jobs(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while self._done:
+            conn, data, keep_alive, last = self._done.popleft()
+            if last:
+                conn.busy = False
+            if conn.closed:
+                continue
+            self._send(conn, data, keep_alive and not self._stopping.is_set(), last)
+
+    # the pool:
+
+    def _reject(self, job):
+        self._push(job.conn, _RESPONSE_503 % self.retry_after, False)
+
+    def _handle(self, job, client_address, waited):
+        self._run(job)
+
+    def _push(self, conn, data, keep_alive, last=True):
+        '''
+        Hand a piece of response to the loop, the last one ends the request.
+        '''
+        with self._flow:
+            conn.queued = conn.queued + len(data)
+        self._done.append((conn, data, keep_alive, last))
+        self._wake()
+
+    def _wait_sent(self, conn):
+        '''
+        Wait until at most stream_buffer bytes of conn are not sent. Return
+        False if the connection closed or the client stopped reading.
+        '''
+        with self._flow:
+            while conn.queued > self.stream_buffer and not conn.closed:
+                queued = conn.queued
+                self._flow.wait(self.keep_alive_timeout)
+                if conn.queued == queued:
+                    return False
+            return not conn.closed
+
+    def _stream(self, job, result, response, body):
+        '''
+        Push the body of result to the loop chunk by chunk. Return False if
+        it ends before the first non-empty chunk, which is left in body.
+        '''
+        it = iter(result)
+        for chunk in it:
+            if chunk:
+                body.append(chunk)
+                break
+        else:
+            return False
+        status, headers = response
+        if job.environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+            # no chunked encoding, the body ends when the connection closes:
+            job.keep_alive = False
+        chunked = job.keep_alive and not any(k.lower() == 'content-length' for k, v in headers)
+        data = ''.join(body)
+        job.streaming = True
+        self._push(job.conn, _http_head(status, headers, job.keep_alive) + (_http_chunk(data) if chunked else data), job.keep_alive, False)
+        for chunk in it:
+            if not chunk:
+                continue
+            if not self._wait_sent(job.conn):
+                self._push(job.conn, '', False)
+                return True
+            self._push(job.conn, _http_chunk(chunk) if chunked else chunk, job.keep_alive, False)
+        self._push(job.conn, '0\r\n\r\n' if chunked else '', job.keep_alive)
+        return True
+
+    def _run(self, job):
+        '''
+        Run the application for job in a pool thread and push the response
+        to the loop.
+        '''
+        environ = job.environ
+        environ['transwarp.deadline'] = self.current_deadline()
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if response:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            response[:] = [status, headers]
+            return body.append
+
+        body = []
+        try:
+            result = self.application(environ, start_response)
+            try:
+                if not isinstance(result, (list, tuple)) and environ['REQUEST_METHOD'] != 'HEAD':
+                    if self._stream(job, result, response, body):
+                        return
+                else:
+                    for chunk in result:
+                        if chunk:
+                            body.append(chunk)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            status, headers = response
+        except Exception:
+            logging.exception('error handling %s %s:' % (environ['REQUEST_METHOD'], environ['PATH_INFO']))
+            job.keep_alive = False
+            if job.streaming:
+                return self._push(job.conn, '', False)
+            return self._push(job.conn, _http_response('500 Internal Server Error', [('Content-Type', 'text/plain')], 'Internal Server Error', False), False)
+        data = ''.join(body)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            headers = headers if any(k.lower() == 'content-length' for k, v in headers) else headers + [('Content-Length', str(len(data)))]
+            data = ''
+        self._push(job.conn, _http_response(status, headers, data, job.keep_alive), job.keep_alive)
+
+    def stats(self):
+        '''
+        Return the ThreadPoolServer counters plus connections, the number of
+        open connections, and keep_alive_reuses, requests that came on a
+        connection already used.
+        '''
+        st = ThreadPoolServer.stats(self)
+        st.connections = len(self._conns)
+        st.keep_alive_reuses = self._keep_alive_reuses
+        return st
+
+
+def _serve_until(server, stopping, tick=None, graceful_timeout=30):
+    '''
+    Run server in threads until the stopping event is set, calling tick()
+    every second from the calling thread, which must be the main thread.
+    '''
+    server.start()
+    acceptor = threading.Thread(target=server.serve_forever, name='transwarp-acceptor')
+    acceptor.daemon = True
+    acceptor.start()
+    # signals are only delivered to the main thread, which must not block:
+    while not stopping.is_set():
+        stopping.wait(1.0)
+        tick and tick()
+    server.shutdown()
+    server.stop(graceful_timeout)
+    tick and tick()
+
+
+def serve(app, host='127.0.0.1', port=9000, threads=8, graceful_timeout=30, server_class=ThreadPoolServer, **kw):
+    '''
+    Serve app with a ThreadPoolServer, or server_class, in this process until
+    SIGTERM or SIGINT. SIGUSR1 logs the server stats. Other keyword args go
+    to the server.
+    '''
+    stopping = threading.Event()
+    server = server_class(create_listener(host, port), app, threads=threads, **kw)
+
+    def _on_stop(signum, frame):
+        stopping.set()
+
+    def _on_stats(signum, frame):
+        logging.info('server stats: %s' % server.stats())
+
+    signal.signal(signal.SIGTERM, _on_stop)
+    signal.signal(signal.SIGINT, _on_stop)
+    signal.signal(signal.SIGUSR1, _on_stats)
+    logging.info('listening at %s:%s with %s threads...' % (host, port, threads))
+    _serve_until(server, stopping, graceful_timeout=graceful_timeout)
+    server.server_close()
+
+
+# functions called in every worker right after the fork:
+_after_fork = []
+
+
+def after_fork(fn):
+    '''
+    Register fn() to run in every PreforkServer worker after it is forked and
+    before the application is built, e.g. db.reset_after_fork to drop pooled
+    connections the master opened.
+    '''
+    _after_fork.append(fn)
+
+
+# per worker counters in memory shared with the master:
+_SLOT_FIELDS = ('pid', 'started_at', 'served', 'rejected', 'expired', 'queued', 'busy')
+_SLOT = struct.Struct('qdQQQQQ')
+
+
+class PreforkServer(object):
+    '''
+    Master process forking workers that share one listening socket.
+
+    Args:
+        app_factory: function returning the wsgi callable, called in every worker
+            after the fork so each one builds its own application state.
+        workers: number of worker processes, about one per core.
+        threads: threads per worker serving requests.
+        graceful_timeout: seconds a stopping worker has to finish its requests
+            before it is killed.
+        server_class: ThreadPoolServer or EventLoopServer run by every worker.
+        kw: passed to the server of every worker, e.g. queue_size and deadline.
+    '''
+
+    def __init__(self, app_factory, host='127.0.0.1', port=9000, workers=2, threads=1, backlog=128, graceful_timeout=30, server_class=ThreadPoolServer, **kw):
+        if workers < 1 or threads < 1:
+            raise ValueError('Invalid server size: workers=%s, threads=%s' % (workers, threads))
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.server_class = server_class
+        self.server_args = kw
+        self._listener = None
+        self._slots = None
+        # pid => worker index:
+        self._children = {}
+        # pid => time SIGTERM was sent:
+        self._retiring = {}
+        self._stopping = False
+        self._reloading = False
+
+    def stats(self):
+        '''
+        Return counters of each worker as a list of Dict(index, pid, started_at,
+        served, rejected, expired, queued, busy), updated every second.
+        '''
+        L = []
+        for index in range(self.workers):
+            st = Dict(_SLOT_FIELDS, _SLOT.unpack_from(self._slots, index * _SLOT.size))
+            st.index = index
+            L.append(st)
+        return L
+
+    def serve_forever(self):
+        self._listener = create_listener(self.host, self.port, self.backlog)
+        self._slots = mmap.mmap(-1, _SLOT.size * self.workers)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGUSR1, self._on_stats)
+        logging.info('master %s listening at %s:%s with %s workers x %s threads...' % (os.getpid(), self.host, self.port, self.workers, self.threads))
+        for index in range(self.workers):
+            self._spawn(index)
+        try:
+            while not self._stopping:
+                if self._reloading:
+                    self._reloading = False
+                    self._reload()
+                self._reap()
+                self._kill_overdue()
+                time.sleep(0.5)
+        finally:
+            self._shutdown()
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
+
+    def _on_stats(self, signum, frame):
+        for st in self.stats():
+            logging.info('worker %(index)s pid %(pid)s: served %(served)s, rejected %(rejected)s, expired %(expired)s, queued %(queued)s, busy %(busy)s' % st)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = index
+            return pid
+        # in the worker:
+        code = 0
+        try:
+            _Worker(self, index).run()
+        except BaseException:
+            logging.exception('worker %s failed:' % index)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _reload(self):
+        logging.info('reloading workers...')
+        for pid, index in self._children.items():
+            if pid in self._retiring:
+                continue
+            self._retire(pid)
+            self._spawn(index)
+
+    def _retire(self, pid):
+        self._retiring[pid] = time.time()
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            index = self._children.pop(pid, None)
+            if self._retiring.pop(pid, None) is not None or index is None or self._stopping:
+                continue
+            logging.warning('worker %s pid %s exited with status %s, respawn.' % (index, pid, status))
+            # do not spin when a worker dies at start:
+            if time.time() - self.stats()[index].started_at < 1.0:
+                time.sleep(1.0)
+            self._spawn(index)
+
+    def _kill_overdue(self):
+        now = time.time()
+        for pid, t in self._retiring.items():
+            if now - t > self.graceful_timeout:
+                logging.warning('worker pid %s did not stop in time, kill it.' % pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                self._retiring[pid] = now
+
+    def _shutdown(self):
+        logging.info('stopping workers...')
+        for pid in self._children.keys():
+            if pid not in self._retiring:
+                self._retire(pid)
+        while self._children:
+            self._reap()
+            self._kill_overdue()
+            if self._children:
+                time.sleep(0.1)
+        self._listener.close()
+
+
+class _Worker(object):
+    '''
+    A worker process, serving on the master's listener until SIGTERM.
+    '''
+
+    def __init__(self, master, index):
+        self.master = master
+        self.index = index
+        self.started_at = time.time()
+        self._stopping = threading.Event()
+        self.server = None
+        self._write_slot()
+
+    def _write_slot(self):
+        st = self.server.stats() if self.server else Dict()
+        _SLOT.pack_into(self.master._slots, self.index * _SLOT.size, os.getpid(), self.started_at, \
+                st.get('served', 0), st.get('rejected', 0), st.get('expired', 0), st.get('queued', 0), st.get('busy', 0))
+
+    def _on_stop(self, signum, frame):
+        self._stopping.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        for fn in _after_fork:
+            fn()
+        master = self.master
+        self.server = master.server_class(master._listener, master.app_factory(), master.threads, **master.server_args)
+        _serve_until(self.server, self._stopping, self._write_slot, master.graceful_timeout)
+
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    import doctest
+    doctest.testmod()
@@ -6,13 +6,16 @@
 A simple, lightweight, WSGI-compatible web framework.
 '''
 
-import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging, urllib, traceback
+import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging, urllib, traceback, stat, mmap, collections, zlib
+import email.utils, weakref
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+from cache import LocalCache
+
 # thread local object for storing request and response
 
 
@@ -452,33 +455,478 @@ class Route(object):
     __repr__ = __str__
 
 
-def _static_file_generator(fpath):
-    BLOCK_SIZE = 8192
+_re_param_segment = re.compile(r'^\:[a-zA-Z_]\w*$')
+
+
+class _RouteNode(object):
+
+    __slots__ = ('static', 'patterns', 'param', 'route', 'tail')
+
+    def __init__(self):
+        self.static = {}
+        self.patterns = []
+        self.param = None
+        self.route = None
+        self.tail = None
+
+
+class Router(object):
+    '''
+    Match request paths against routes of one http method.
+
+    Static paths are looked up in a dict, dynamic paths walk a trie of path
+    segments, so matching cost depends on path depth, not route count. At
+    each segment a static child is tried first, then segments mixing text
+    and :params, then a plain :param. A route with a prefix attribute, like
+    StaticFileRoute, catches every path below its prefix with lowest priority.
+
+    >>> r = Router()
+    >>> for path in ('/blog/:id', '/blog/new', '/blog/:id/comments', '/doc/v:ver/:page'):
+    ...     r.add(Route(get(path)(lambda *args: args)))
+    >>> r.add(StaticFileRoute())
+    >>> r.match('/blog/new')[0].path
+    '/blog/new'
+    >>> route, args = r.match('/blog/123/comments')
+    >>> route.path, args
+    ('/blog/:id/comments', ('123',))
+    >>> r.match('/doc/v2/intro')[1]
+    ('2', 'intro')
+    >>> r.match('/static/css/uikit.css')[1]
+    ('static/css/uikit.css',)
+    >>> r.match('/blog/123/likes') is None
+    True
+    '''
+
+    def __init__(self):
+        self._static = {}
+        self._root = _RouteNode()
+
+    def add(self, route):
+        prefix = getattr(route, 'prefix', None)
+        if prefix:
+            node = self._walk(prefix.rstrip('/'))
+            if node.tail is None:
+                node.tail = route
+            return
+        if route.is_static:
+            self._static.setdefault(route.path, route)
+            return
+        node = self._walk(route.path)
+        # the first registered route wins, like the linear scan did:
+        if node.route is None:
+            node.route = route
+
+    def _walk(self, path):
+        node = self._root
+        for seg in path.split('/')[1:]:
+            if _re_param_segment.match(seg):
+                if node.param is None:
+                    node.param = _RouteNode()
+                node = node.param
+            elif _re_route.search(seg):
+                for p, regex, child in node.patterns:
+                    if p == seg:
+                        break
+                else:
+                    child = _RouteNode()
+                    node.patterns.append((seg, re.compile(_build_regex(seg)), child))
+                node = child
+            else:
+                node = node.static.setdefault(seg, _RouteNode())
+        return node
+
+    def routes(self):
+        '''
+        Return all routes added.
+        '''
+        L = self._static.values()
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            if node.route:
+                L.append(node.route)
+            if node.tail:
+                L.append(node.tail)
+            nodes.extend(node.static.itervalues())
+            nodes.extend(child for p, regex, child in node.patterns)
+            if node.param:
+                nodes.append(node.param)
+        return L
+
+    def match(self, path):
+        '''
+        Return (route, args) for path, or None if no route matches.
+        '''
+        route = self._static.get(path)
+        if route:
+            return route, ()
+        return self._match(self._root, path.split('/')[1:], 0, (), path)
+
+    def _match(self, node, segs, i, args, path):
+        if i == len(segs):
+            if node.route:
+                return node.route, args
+            return None
+        seg = segs[i]
+        child = node.static.get(seg)
+        if child:
+            r = self._match(child, segs, i + 1, args, path)
+            if r:
+                return r
+        for p, regex, child in node.patterns:
+            m = regex.match(seg)
+            if m:
+                r = self._match(child, segs, i + 1, args + m.groups(), path)
+                if r:
+                    return r
+        if node.param and seg:
+            r = self._match(node.param, segs, i + 1, args + (seg, ), path)
+            if r:
+                return r
+        if node.tail:
+            args = node.tail.match(path)
+            if args:
+                return node.tail, args
+        return None
+
+
+_BLOCK_SIZE = 65536
+
+
+def _static_file_generator(fpath, start=0, length=None):
     with open(fpath, 'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
+        if start:
+            f.seek(start)
+        while length is None or length > 0:
+            block = f.read(_BLOCK_SIZE if length is None else min(_BLOCK_SIZE, length))
+            if not block:
+                break
+            if length is not None:
+                length = length - len(block)
             yield block
-            block = f.read(BLOCK_SIZE)
+
+
+def _http_date(t):
+    return email.utils.formatdate(t, usegmt=True)
+
+
+def _parse_http_date(s):
+    try:
+        t = email.utils.parsedate_tz(s)
+        return email.utils.mktime_tz(t) if t else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _accepts_encoding(header, coding):
+    '''
+    Return True if an Accept-Encoding header value accepts coding.
+
+    >>> _accepts_encoding('gzip, deflate', 'gzip')
+    True
+    >>> _accepts_encoding('gzip;q=0, br', 'gzip')
+    False
+    >>> _accepts_encoding('*', 'gzip')
+    True
+    >>> _accepts_encoding(None, 'gzip')
+    False
+    '''
+
+    if not header:
+        return False
+    for item in header.split(','):
+        L = item.split(';')
+        name = L[0].strip().lower()
+        if name != coding and name != '*':
+            continue
+        for param in L[1:]:
+            k, _, v = param.partition('=')
+            if k.strip() == 'q':
+                try:
+                    return float(v) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _parse_range(value, size):
+    '''
+    Parse a single byte range. Return (start, end) with end inclusive, None if
+    the header should be ignored, or False if the range is not satisfiable.
+
+    >>> _parse_range('bytes=0-99', 1000)
+    (0, 99)
+    >>> _parse_range('bytes=-100', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=900-2000', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=1000-', 1000)
+    False
+    >>> _parse_range('bytes=0-1,5-6', 1000) is None
+    True
+    '''
+
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    first, _, last = value[6:].strip().partition('-')
+    try:
+        if not first:
+            n = int(last)
+            if n <= 0:
+                return False
+            return (max(size - n, 0), size - 1)
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return (start, min(end, size - 1))
+
+
+class AssetCache(object):
+    '''
+    Keep hot static files in memory for StaticFileRoute.
+
+    Files up to max_file_size are cached, keyed by path and validated by
+    mtime and size. Files smaller than mmap_size are read into memory, larger
+    ones are memory-mapped. The least recently used files are dropped when
+    more than max_bytes are resident.
+
+    With zero_copy=True bodies are memoryview slices of the cached data, for
+    servers that write buffers straight to the socket. wsgiref only accepts
+    str, so by default whole files are sent as the cached str and ranges or
+    mapped files as str blocks.
+
+    >>> import tempfile
+    >>> fd, fpath = tempfile.mkstemp()
+    >>> os.write(fd, 'hello, world')
+    12
+    >>> os.close(fd)
+    >>> c = AssetCache(max_bytes=100)
+    >>> info = _FileInfo(os.path.getmtime(fpath), 12)
+    >>> ''.join(c.body(c.get(fpath, info), 7, 5))
+    'world'
+    >>> c.get(fpath, info) is not None
+    True
+    >>> st = c.stats()
+    >>> st['hits'], st['misses'], st['resident_bytes']
+    (1, 1, 12)
+    >>> os.remove(fpath)
+    '''
+
+    def __init__(self, max_file_size=1048576, max_bytes=67108864, mmap_size=262144, zero_copy=False):
+        self.max_file_size = max_file_size
+        self.max_bytes = max_bytes
+        self.mmap_size = mmap_size
+        self.zero_copy = zero_copy
+        self._lock = threading.Lock()
+        # fpath => (mtime, size, data), least recently used first:
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, fpath, info):
+        '''
+        Return cached data (str or mmap) of the file, or None if not cacheable.
+        '''
+        with self._lock:
+            entry = self._entries.pop(fpath, None)
+            if entry:
+                if entry[0] == info.mtime and entry[1] == info.size:
+                    self._entries[fpath] = entry
+                    self._hits = self._hits + 1
+                    return entry[2]
+                self._bytes = self._bytes - entry[1]
+            self._misses = self._misses + 1
+        if info.size > self.max_file_size or info.size > self.max_bytes:
+            return None
+        data = self._load(fpath, info.size)
+        if data is None:
+            return None
+        with self._lock:
+            old = self._entries.pop(fpath, None)
+            if old:
+                self._bytes = self._bytes - old[1]
+            self._entries[fpath] = (info.mtime, info.size, data)
+            self._bytes = self._bytes + info.size
+            # mapped files are unmapped by gc once no response uses them:
+            while self._bytes > self.max_bytes:
+                k, e = self._entries.popitem(last=False)
+                self._bytes = self._bytes - e[1]
+        return data
+
+    def _load(self, fpath, size):
+        try:
+            with open(fpath, 'rb') as f:
+                if size and size >= self.mmap_size:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                data = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        # the file changed between stat and read:
+        return data if len(data) == size else None
+
+    def body(self, data, start=0, length=None):
+        '''
+        Return the wsgi iterable for length bytes of data from start.
+        '''
+        end = len(data) if length is None else start + length
+        if isinstance(data, str):
+            if self.zero_copy:
+                return [memoryview(data)[start:end]]
+            if start == 0 and end == len(data):
+                return [data]
+            return [data[start:end]]
+        return self._blocks(data, start, end)
+
+    def _blocks(self, data, start, end):
+        while start < end:
+            n = min(_BLOCK_SIZE, end - start)
+            # py2 mmap has no new-style buffer, buffer() is its zero-copy view:
+            yield buffer(data, start, n) if self.zero_copy else data[start:start + n]
+            start = start + n
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return dict(hits=self._hits, misses=self._misses, hit_rate=float(self._hits) / total if total else 0.0, \
+                    entries=len(self._entries), resident_bytes=self._bytes, max_bytes=self.max_bytes)
+
+
+class _FileInfo(object):
+
+    __slots__ = ('mtime', 'size', 'etag', 'last_modified', 'checked_at')
+
+    def __init__(self, mtime, size, suffix=''):
+        self.mtime = mtime
+        self.size = size
+        self.checked_at = time.time()
+        self.etag = '"%x-%x%s"' % (int(mtime), size, suffix)
+        self.last_modified = _http_date(mtime)
 
 
 class StaticFileRoute(object):
+    '''
+    Serve files under document_root/static.
+
+    Responses carry ETag and Last-Modified, conditional GETs get 304, single
+    byte ranges get 206, and a fresh 'x.css.gz' sibling is sent for 'x.css'
+    to clients accepting gzip. Full files go through wsgi.file_wrapper when
+    the server provides one, so it can use sendfile().
+
+    Args:
+        max_age: optional, seconds for a 'Cache-Control: public, max-age' header.
+        cache: optional AssetCache to serve hot files from memory.
+        check_interval: seconds a file's stat is trusted before it is checked
+            again, default to 0 that stats on every request.
+    '''
 
-    def __init__(self):
+    def __init__(self, max_age=None, cache=None, check_interval=0):
         self.method = 'GET'
         self.is_static = False
+        self.prefix = '/static/'
+        # static files never need interceptors such as binding the session user:
+        self.intercept = False
         self.route = re.compile('^/static/(.+)$')
+        self.max_age = max_age
+        self.cache = cache
+        self.check_interval = check_interval
+        # fpath => _FileInfo, rebuilt when mtime or size changes:
+        self._infos = {}
 
     def match(self, url):
         if url.startswith('/static/'):
             return (url[1:], )
         return None
 
+    def _info(self, fpath, suffix=''):
+        info = self._infos.get(fpath)
+        if info and self.check_interval and time.time() - info.checked_at < self.check_interval:
+            return info
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        if info is None or info.mtime != st.st_mtime or info.size != st.st_size:
+            info = _FileInfo(st.st_mtime, st.st_size, suffix)
+            self._infos[fpath] = info
+        else:
+            info.checked_at = time.time()
+        return info
+
+    def _not_modified(self, request, info):
+        etags = request.header('If-None-Match')
+        if etags is not None:
+            return etags.strip() == '*' or info.etag in [t.strip() for t in etags.split(',')]
+        since = _parse_http_date(request.header('If-Modified-Since'))
+        return since is not None and int(info.mtime) <= since
+
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+        root = os.path.join(ctx.application.document_root, 'static')
+        fpath = os.path.normpath(os.path.join(ctx.application.document_root, args[0]))
+        if not fpath.startswith(root + os.sep):
+            raise notfound()
+        info = self._info(fpath)
+        if info is None:
             raise notfound()
+        request = ctx.request
+        response = ctx.response
         fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        gz = self._info(fpath + '.gz', '-gz')
+        if gz:
+            response.set_header('Vary', 'Accept-Encoding')
+            if gz.mtime >= info.mtime and _accepts_encoding(request.header('Accept-Encoding'), 'gzip'):
+                fpath = fpath + '.gz'
+                info = gz
+                response.set_header('Content-Encoding', 'gzip')
+        response.set_header('ETag', info.etag)
+        response.set_header('Last-Modified', info.last_modified)
+        response.set_header('Accept-Ranges', 'bytes')
+        if self.max_age is not None:
+            response.set_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+        if self._not_modified(request, info):
+            response.status = 304
+            response.unset_header('Content-Type')
+            return []
+        r = None
+        if_range = request.header('If-Range')
+        if if_range is None or if_range == info.etag:
+            r = _parse_range(request.header('Range'), info.size)
+        if r is False:
+            response.status = 416
+            response.set_header('Content-Range', 'bytes */%d' % info.size)
+            return []
+        if r:
+            start, end = r
+            response.status = 206
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, info.size))
+            response.content_length = end - start + 1
+            if self.cache:
+                data = self.cache.get(fpath, info)
+                if data is not None:
+                    return self.cache.body(data, start, end - start + 1)
+            return _static_file_generator(fpath, start, end - start + 1)
+        response.content_length = info.size
+        if self.cache:
+            data = self.cache.get(fpath, info)
+            if data is not None:
+                return self.cache.body(data)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(open(fpath, 'rb'), _BLOCK_SIZE)
         return _static_file_generator(fpath)
 
 
@@ -1025,6 +1473,9 @@ class Response(object):
 
 class Template(object):
 
+    # True or False to stream this template, None to follow the engine:
+    stream = None
+
     def __init__(self, template_name, **kw):
         '''
         >>> t = Template('hello.html', title='Hello', copyright='@2012')
@@ -1042,9 +1493,18 @@ class TemplateEngine(object):
     Base template engine
     '''
 
+    # stream templates unless Template.stream says otherwise:
+    streaming = False
+
     def __call__(self, path, model):
         return '<!-- override this method to render template -->'
 
+    def stream(self, path, model):
+        '''
+        Return the rendered template as an iterable of str chunks.
+        '''
+        return [self(path, model)]
+
 class Jinja2TemplateEngine(TemplateEngine):
     '''
     Render using jinja2 template engine.
@@ -1056,18 +1516,69 @@ class Jinja2TemplateEngine(TemplateEngine):
     '<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>'
     '''
 
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, templ_dir, bytecode_cache=None, streaming=False, stream_buffer=40, **kw):
+        '''
+        Args:
+            templ_dir: directory of templates.
+            bytecode_cache: optional, a directory to store compiled templates so a
+                restarted process skips compiling them, or True for a temp directory.
+            auto_reload: default to True that stats the template file on every
+                render to pick up changes, set False in production.
+            streaming: default to False, True to stream every template, see stream().
+            stream_buffer: template output events joined into one streamed chunk.
+            other keyword args are passed to jinja2.Environment.
+        '''
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
         if 'autoescape' not in kw:
             kw['autoescape'] = True
+        if bytecode_cache is True:
+            kw['bytecode_cache'] = FileSystemBytecodeCache()
+        elif bytecode_cache:
+            if not os.path.isdir(bytecode_cache):
+                os.makedirs(bytecode_cache)
+            kw['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
         self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+        self.streaming = streaming
+        self.stream_buffer = stream_buffer
 
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
 
+    def add_global(self, name, value):
+        self._env.globals[name] = value
+
+    def precompile(self, extensions=('html', )):
+        '''
+        Load every template so the first request does not pay for parsing and
+        compiling. Call it after add_filter(). Return the number of templates.
+        '''
+        names = self._env.list_templates(extensions=extensions)
+        for name in names:
+            self._env.get_template(name)
+        logging.info('precompiled %d templates.' % len(names))
+        return len(names)
+
     def __call__(self, path, model):
         return self._env.get_template(path).render(**model).encode('utf-8')
 
+    def stream(self, path, model):
+        '''
+        Render with jinja2's stream(), so the page is never held as one unicode
+        string plus its utf-8 copy and the first bytes go out early. The first
+        chunk is rendered at once to surface early template errors as a 500.
+        '''
+        s = self._env.get_template(path).stream(**model)
+        s.enable_buffering(self.stream_buffer)
+        first = next(s, None)
+        return _encode_chunks(first, s)
+
+
+def _encode_chunks(first, it):
+    if first is not None:
+        yield first.encode('utf-8')
+    for chunk in it:
+        yield chunk.encode('utf-8')
+
 
 def _default_error_handler(e, start_response, is_debug):
     if isinstance(e, HttpError):
@@ -1082,9 +1593,10 @@ def _default_error_handler(e, start_response, is_debug):
         return _debug()
     return ('<html><body><h1> 500 Internal Server Error</h1><h3>%s</h3></body></html>' % str(e))
 
-def view(path):
+def view(path, stream=None):
     '''
-    A view decorator that render a view by dict.
+    A view decorator that render a view by dict. Pass stream=True or False to
+    override whether the template engine streams this view.
 
     >>> @view('test/view.html')
     ... def hello():
@@ -1109,12 +1621,180 @@ def view(path):
             r = func(*args, **kw)
             if isinstance(r, dict):
                 logging.info('return Template')
-                return Template(path, **r)
+                t = Template(path, **r)
+                t.stream = stream
+                return t
             raise ValueError('Expect return a dict when using @view() decorator.')
         return _wrapper
     return _decorator
 
 
+class ResponseCache(object):
+    '''
+    Cache of rendered pages and template fragments.
+
+    Entries carry tags. invalidate(*tags) drops every entry stored with one of
+    the tags, e.g. when a blog is written. The module level invalidate() applies
+    to every ResponseCache. An entry older than its ttl is kept
+    for another stale seconds, set per cache or per call. During that time
+    one thread renders it again while the others are served the stale copy.
+
+    >>> c = ResponseCache()
+    >>> c.get_or_render('k', 30, ('blogs', ), lambda: ('v1', True))
+    'v1'
+    >>> c.get_or_render('k', 30, ('blogs', ), lambda: ('v2', True))
+    'v1'
+    >>> c.invalidate('blogs')
+    >>> c.get_or_render('k', 30, ('blogs', ), lambda: ('v2', True))
+    'v2'
+    >>> c.get_or_render('s', -1, (), lambda: ('v1', True), stale=0)
+    'v1'
+    >>> c.get_or_render('s', -1, (), lambda: ('v2', True), stale=0)
+    'v2'
+    '''
+
+    def __init__(self, backend=None, stale=30):
+        self._store = backend or LocalCache(ttl=0, max_entries=10000)
+        self.stale = stale
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._tags = {}
+        self._stale_hits = 0
+        _response_caches.add(self)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._tags[tag] = self._tags.get(tag, 0) + 1
+
+    def _versions(self, tags):
+        return tuple(self._tags.get(tag, 0) for tag in tags)
+
+    def get_or_render(self, key, ttl, tags, render, stale=None):
+        '''
+        Return the cached value of key, or call render() that returns (value, cacheable).
+        stale overrides the cache's stale window for this entry.
+        '''
+        if stale is None:
+            stale = self.stale
+        # take tag versions before rendering, so a write during render is not hidden:
+        versions = self._versions(tags)
+        entry = self._store.get(key)
+        if entry and entry[1] == versions:
+            now = time.time()
+            if entry[0] > now:
+                return entry[2]
+            # past the stale window every thread renders:
+            if entry[0] + stale <= now:
+                return self._render(key, ttl, stale, versions, render)
+            with self._lock:
+                refresh = key not in self._refreshing
+                if refresh:
+                    self._refreshing.add(key)
+                else:
+                    self._stale_hits = self._stale_hits + 1
+            if not refresh:
+                return entry[2]
+            try:
+                return self._render(key, ttl, stale, versions, render)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        return self._render(key, ttl, stale, versions, render)
+
+    def _render(self, key, ttl, stale, versions, render):
+        value, cacheable = render()
+        if cacheable:
+            self._store.set(key, (time.time() + ttl, versions, value), ttl + stale)
+        return value
+
+    def stats(self):
+        st = dict(self._store.stats())
+        st['stale_hits'] = self._stale_hits
+        return st
+
+    def fragment(self, key, ttl=60, tags=(), caller=None):
+        '''
+        Cache part of a template, registered as a template global:
+
+        {% call fragment('sidebar', 300) %}...{% endcall %}
+        '''
+        return self.get_or_render('fragment:%s' % key, ttl, tags, lambda: (caller(), True))
+
+
+_response_caches = weakref.WeakSet()
+
+# default cache used by @cached and the fragment template global:
+response_cache = ResponseCache()
+
+
+def invalidate(*tags):
+    '''
+    Drop entries stored with any of tags from every ResponseCache.
+    '''
+    for c in list(_response_caches):
+        c.invalidate(*tags)
+
+
+def fragment(key, ttl=60, tags=(), caller=None):
+    '''
+    Template global caching the body of a {% call fragment(...) %} block.
+    '''
+    return response_cache.fragment(key, ttl, tags, caller)
+
+
+def _vary_key(name):
+    if name == 'user':
+        user = getattr(ctx.request, 'user', None)
+        return user.id if user else ''
+    return ctx.request.header(name, '')
+
+
+def cached(ttl=30, vary=(), tags=(), stale=None):
+    '''
+    A decorator that caches the rendered response of a @view or text handler,
+    put above @view(). The key is the path and query string plus vary, where
+    'user' means the signed in user and other names are request headers.
+    tags are formatted with the handler args, e.g. 'blog:{0}', and dropped
+    by invalidate(). Responses setting cookies or a non-200 status are not cached.
+    stale is how long an expired page is still served while it is rendered
+    again, None for the response_cache default.
+
+    @cached(ttl=30, vary=('user', ), tags=('blog:{0}', ))
+    @view('blog_detail.html')
+    @get('/blog/:bid')
+    def get_blog(bid):
+        pass
+    '''
+
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args):
+            request = ctx.request
+            key = ['page', request.path_info, request.query_string]
+            key.extend(_to_str(_vary_key(v)) for v in vary)
+            entry_tags = tuple(t.format(*args) for t in tags)
+
+            def _render():
+                r = func(*args)
+                response = ctx.response
+                if isinstance(r, Template):
+                    r = ctx.application.template_engine(r.template_name, r.model)
+                elif isinstance(r, unicode):
+                    r = r.encode('utf-8')
+                if not isinstance(r, str):
+                    return r, False
+                cacheable = response.status_code == 200 and not getattr(response, '_cookies', None)
+                return (response.content_type, r), cacheable
+            r = response_cache.get_or_render('\0'.join(key), ttl, entry_tags, _render, stale)
+            if isinstance(r, tuple):
+                ctx.response.content_type = r[0]
+                return r[1]
+            return r
+        return _wrapper
+    return _decorator
+
+
 _RE_INTERCEPTROR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
 _RE_INTERCEPTROR_ENDS_WITH = re.compile(r'^\*([^\*\?]+)$')
 
@@ -1125,7 +1805,7 @@ def _build_pattern_fn(pattern):
         return lambda p: p.startswith(m.group(1))
     m = _RE_INTERCEPTROR_ENDS_WITH.match(pattern)
     if m:
-        return lambda p: p.endwith(m.group(1))
+        return lambda p: p.endswith(m.group(1))
     raise ValueError('Invalid pattern definition in interceptor.')
 
 
@@ -1140,6 +1820,7 @@ def interceptor(pattern='/'):
 
     def _decorator(func):
         func.__interceptor__ = _build_pattern_fn(pattern)
+        func.__interceptor_pattern__ = pattern
         return func
     return _decorator
 
@@ -1200,6 +1881,222 @@ def _build_interceptor_chain(last_fn, *interceptors):
     return fn
 
 
+def _route_affixes(route):
+    '''
+    Return the fixed prefix and suffix of all paths a route can match,
+    suffix is None if unknown.
+
+    >>> _route_affixes(Route(get('/blog/:id/comments')(lambda: None)))
+    ('/blog/', '/comments')
+    '''
+
+    prefix = getattr(route, 'prefix', None)
+    if prefix:
+        return prefix, None
+    if route.is_static:
+        return route.path, route.path
+    L = _re_route.split(route.path)
+    return L[0], L[-1]
+
+
+def _interceptor_applies(func, route):
+    '''
+    Return True if the interceptor applies to every path of route, False if
+    to none, or None if it depends on the actual path.
+
+    >>> f = interceptor('/manage/')(lambda next: next())
+    >>> _interceptor_applies(f, Route(get('/manage/blogs/:bid')(lambda: None)))
+    True
+    >>> _interceptor_applies(f, Route(get('/blog/:bid')(lambda: None)))
+    False
+    >>> _interceptor_applies(f, Route(get('/:section/blogs')(lambda: None))) is None
+    True
+    '''
+
+    pattern = getattr(func, '__interceptor_pattern__', None)
+    if pattern is None:
+        return None
+    if route.is_static and not getattr(route, 'prefix', None):
+        return bool(func.__interceptor__(route.path))
+    prefix, suffix = _route_affixes(route)
+    m = _RE_INTERCEPTROR_STARTS_WITH.match(pattern)
+    if m:
+        p = m.group(1)
+        if prefix.startswith(p):
+            return True
+        return None if p.startswith(prefix) else False
+    m = _RE_INTERCEPTROR_ENDS_WITH.match(pattern)
+    if m and suffix is not None:
+        p = m.group(1)
+        if suffix.endswith(p):
+            return True
+        return None if p.endswith(suffix) else False
+    return None
+
+
+def _build_route_chain(last_fn, route, interceptors):
+    '''
+    Build the interceptor chain of one route at startup. Interceptors known to
+    apply are bound with functools.partial, which adds no python frame, those
+    that depend on the path keep the per-request check, others are dropped.
+    '''
+
+    if not getattr(route, 'intercept', True):
+        return last_fn
+    fn = last_fn
+    for f in reversed(interceptors):
+        applies = _interceptor_applies(f, route)
+        if applies:
+            fn = functools.partial(f, fn)
+        elif applies is None:
+            fn = _build_interceptor_fn(f, fn)
+    return fn
+
+
+_COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/x-javascript', \
+        'application/xml', 'application/rss+xml', 'image/svg+xml')
+
+
+def _header_value(headers, name):
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return None
+
+
+def _replace_header(headers, name, value):
+    lname = name.lower()
+    L = [(k, v) for k, v in headers if k.lower() != lname]
+    if value is not None:
+        L.append((name, value))
+    return L
+
+
+class GzipMiddleware(object):
+    '''
+    Wsgi middleware that gzips responses for clients sending Accept-Encoding: gzip.
+
+    Only text-like content types are compressed. Responses that are already
+    encoded, partial, or smaller than min_size are passed through, and so are
+    responses with an ETag or Last-Modified: those come from StaticFileRoute,
+    which serves .gz siblings and answers conditional requests itself. A list
+    body is compressed at once and gets a new Content-Length. Any other
+    iterable, such as a generator, is compressed chunk by chunk as it streams.
+    Compressible responses always get 'Vary: Accept-Encoding'.
+
+    >>> import gzip
+    >>> def app(environ, start_response):
+    ...     start_response('200 OK', [('Content-Type', 'text/html'), ('Content-Length', '2000')])
+    ...     return ['x' * 2000]
+    >>> headers = []
+    >>> body = GzipMiddleware(app)({'HTTP_ACCEPT_ENCODING': 'gzip'}, lambda s, h: headers.extend(h))
+    >>> sorted(headers)
+    [('Content-Encoding', 'gzip'), ('Content-Length', '35'), ('Content-Type', 'text/html'), ('Vary', 'Accept-Encoding')]
+    >>> len(gzip.GzipFile(fileobj=StringIO(''.join(body))).read())
+    2000
+    >>> def static_app(environ, start_response):
+    ...     start_response('200 OK', [('Content-Type', 'text/css'), ('ETag', '"1-2"')])
+    ...     return ['x' * 2000]
+    >>> headers = []
+    >>> len(GzipMiddleware(static_app)({'HTTP_ACCEPT_ENCODING': 'gzip'}, lambda s, h: headers.extend(h))[0]), headers
+    (2000, [('Content-Type', 'text/css'), ('ETag', '"1-2"')])
+    '''
+
+    def __init__(self, app, level=6, min_size=1024):
+        self._app = app
+        self.level = level
+        self.min_size = min_size
+
+    def _compressible(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        content_type = _header_value(headers, 'Content-Type') or ''
+        if not content_type.lower().startswith(_COMPRESSIBLE_TYPES):
+            return False
+        for name in ('Content-Encoding', 'Content-Range', 'ETag', 'Last-Modified'):
+            if _header_value(headers, name) is not None:
+                return False
+        return True
+
+    def __call__(self, environ, start_response):
+        captured = []
+
+        def _start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return self._write
+
+        body = self._app(environ, _start_response)
+        if not captured:
+            # the app calls start_response lazily, run it up to the first chunk:
+            it = iter(body)
+            first = next(it, None)
+            body = _chain_body([] if first is None else [first], it, body)
+        status, headers, exc_info = captured
+
+        def _start(headers):
+            if exc_info is None:
+                start_response(status, headers)
+            else:
+                start_response(status, headers, exc_info)
+
+        if not self._compressible(status, headers):
+            _start(headers)
+            return body
+        vary = _header_value(headers, 'Vary')
+        if not vary:
+            headers = _replace_header(headers, 'Vary', 'Accept-Encoding')
+        elif 'accept-encoding' not in vary.lower():
+            headers = _replace_header(headers, 'Vary', '%s, Accept-Encoding' % vary)
+        if not _accepts_encoding(environ.get('HTTP_ACCEPT_ENCODING'), 'gzip'):
+            _start(headers)
+            return body
+        length = _header_value(headers, 'Content-Length')
+        if isinstance(body, (list, tuple)):
+            data = ''.join(body)
+            if len(data) < self.min_size:
+                _start(headers)
+                return [data]
+            z = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = z.compress(data) + z.flush()
+            headers = _replace_header(headers, 'Content-Encoding', 'gzip')
+            headers = _replace_header(headers, 'Content-Length', str(len(data)))
+            _start(headers)
+            return [data]
+        if length is not None and int(length) < self.min_size:
+            _start(headers)
+            return body
+        headers = _replace_header(_replace_header(headers, 'Content-Encoding', 'gzip'), 'Content-Length', None)
+        _start(headers)
+        return self._stream(body)
+
+    def _stream(self, body):
+        z = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        try:
+            for chunk in body:
+                data = z.compress(chunk)
+                if data:
+                    yield data
+            yield z.flush()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _write(self, data):
+        raise RuntimeError('write() is not supported by GzipMiddleware.')
+
+
+def _chain_body(head, it, body):
+    try:
+        for chunk in head:
+            yield chunk
+        for chunk in it:
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
 def _load_module(module_name):
     '''
     Load module from name as str.
@@ -1226,10 +2123,13 @@ class WSGIApplication(object):
 
         Args:
             document_root: document root path
+            compress: optional dict(level=6, min_size=1024) to gzip responses,
+                see GzipMiddleware.
         '''
 
         self._running = False
         self._document_root = document_root
+        self._compress = kw.get('compress')
 
         self._interceptors = []
         self._template_engine = None
@@ -1282,44 +2182,90 @@ class WSGIApplication(object):
         self._interceptors.append(func)
         logging.info('Add interceptor: %s' % str(func))
 
-    def run(self, port=9000, host='127.0.0.1'):
-        from wsgiref.simple_server import make_server
+    def run(self, port=9000, host='127.0.0.1', debug=None, workers=0, threads=1, event_loop=False, static_files=None, **kw):
+        '''
+        Start serving:
+
+        workers=0, threads=1: single threaded wsgiref server, in debug mode
+            unless debug is False.
+        workers=0, threads>1: server.serve(), a pool of threads in this process
+            with a bounded queue answering 503 when full.
+        workers>0: server.PreforkServer, a master forking workers processes
+            sharing the socket, each with a pool of threads threads.
+
+        With event_loop=True the pool is fronted by server.EventLoopServer,
+        holding keep-alive connections without a thread each. Streamed
+        templates and static files are still written as they are produced,
+        the pool thread waiting while stream_buffer bytes are unsent. static_files
+        works like in get_wsgi_application(). Other keyword args such as
+        queue_size and deadline go to the server.
+        '''
+        if not workers and threads <= 1 and not event_loop:
+            from wsgiref.simple_server import make_server
+            logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
+            server = make_server(host, port, self.get_wsgi_application(debug=debug is not False, static_files=static_files))
+            server.serve_forever()
+            return
+        import server
+        self._check_not_running()
         logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
-        server = make_server(host, port, self.get_wsgi_application(debug=True))
-        server.serve_forever()
-
-    def get_wsgi_application(self, debug=False):
+        kw['server_class'] = server.EventLoopServer if event_loop else server.ThreadPoolServer
+        if not workers:
+            server.serve(self.get_wsgi_application(debug=bool(debug), static_files=static_files), host, port, threads=threads, **kw)
+            return
+        master = server.PreforkServer(lambda: self.get_wsgi_application(debug=bool(debug), static_files=static_files), host, port, workers=workers, threads=threads, **kw)
+        master.serve_forever()
+
+    def get_wsgi_application(self, debug=False, static_files=None):
+        '''
+        Return the wsgi callable. Files under /static/ are served when
+        static_files is True, default to serve them only in debug mode.
+        static_files may also be a StaticFileRoute to serve them with.
+        '''
         self._check_not_running()
-        if debug:
-            self._get_dynamic.append(StaticFileRoute())
+        if static_files is None:
+            static_files = debug
+        if static_files:
+            self._get_dynamic.append(static_files if isinstance(static_files, StaticFileRoute) else StaticFileRoute())
         self._running = True
 
-        _application = Dict(document_root=self._document_root)
+        _application = Dict(document_root=self._document_root, template_engine=self._template_engine)
+
+        routers = dict(GET=Router(), POST=Router())
+        for method, static, dynamic in (('GET', self._get_static, self._get_dynamic), ('POST', self._post_static, self._post_dynamic)):
+            for route in static.itervalues():
+                routers[method].add(route)
+            for route in dynamic:
+                routers[method].add(route)
 
         def fn_route():
-            request_method = ctx.request.request_method
-            path_info = ctx.request.path_info
-            if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            if request_method == 'POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_static:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
+            return ctx.route(*ctx.route_args)
+
+        # resolve interceptors per route once, instead of checking each pattern per request:
+        chains = {}
+        for router in routers.itervalues():
+            for route in router.routes():
+                chains[id(route)] = _build_route_chain(fn_route, route, self._interceptors)
+
+        def fn_badrequest():
             raise badrequest()
 
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+        def fn_notfound():
+            raise notfound()
+
+        # unmatched requests still pass the interceptors, e.g. to redirect /manage/*:
+        fallback_badrequest = _build_interceptor_chain(fn_badrequest, *self._interceptors)
+        fallback_notfound = _build_interceptor_chain(fn_notfound, *self._interceptors)
+
+        def fn_exec():
+            router = routers.get(ctx.request.request_method)
+            if router is None:
+                return fallback_badrequest()
+            r = router.match(ctx.request.path_info)
+            if r is None:
+                return fallback_notfound()
+            ctx.route, ctx.route_args = r
+            return chains[id(ctx.route)]()
 
         def wsgi(env, start_response):
             ctx.application = _application
@@ -1328,11 +2274,18 @@ class WSGIApplication(object):
             try:
                 r = fn_exec()
                 if isinstance(r, Template):
-                    r = self._template_engine(r.template_name, r.model)
+                    engine = self._template_engine
+                    if engine.streaming if r.stream is None else r.stream:
+                        r = engine.stream(r.template_name, r.model)
+                    else:
+                        r = engine(r.template_name, r.model)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
                 if r is None:
                     r = []
+                elif isinstance(r, str):
+                    # a bare str would be iterated byte by byte:
+                    r = [r]
                 start_response(response.status, response.headers)
                 return r
             except RedirectError, e:
@@ -1358,6 +2311,10 @@ class WSGIApplication(object):
                 del ctx.application
                 del ctx.request
                 del ctx.response
+                ctx.__dict__.pop('route', None)
+                ctx.__dict__.pop('route_args', None)
+        if self._compress:
+            return GzipMiddleware(wsgi, **self._compress)
         return wsgi
 if __name__ == '__main__':
     sys.path.append('.')
@@ -7,7 +7,9 @@ import logging, os, re, time, base64, hashlib, markdown2
 import sys
 sys.path.append('transwarp')
 
-from web import get, view, post, ctx, interceptor, seeother, notfound
+import db
+from cache import LocalCache
+from web import get, view, post, ctx, interceptor, seeother, notfound, cached, ResponseCache
 
 from models import User, Blog, Comment
 from api import api, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError, Page
@@ -29,6 +31,20 @@ def test_users():
 '''
 
 
+# rendered html keyed by sha1 of the markdown source, shared by all blogs with
+# the same content and never stale since a new content is a new key:
+_markdown_cache = LocalCache(ttl=0, max_entries=100000, max_bytes=configs.markdown.cache_bytes)
+
+
+def markdown(content):
+    key = hashlib.sha1(content.encode('utf-8') if isinstance(content, unicode) else content).hexdigest()
+    html = _markdown_cache.get(key)
+    if html is None:
+        html = markdown2.markdown(content)
+        _markdown_cache.set(key, html)
+    return html
+
+
 def make_singed_cookie(id, password, max_age):
     # build cookie string by: id-expires-md5
     expires = str(int(time.time() + (max_age or 86400)))
@@ -43,24 +59,46 @@ def check_admin():
     raise APIPermissionError('No permission')
 
 
+# verified users by raw cookie, dropped by User.update() through the 'user:<id>' tag.
+# the tag only reaches this process, so with pre-fork workers keep entries briefly:
+_SESSION_TTL = 5 if configs.server.workers > 0 else 300
+_session_cache = ResponseCache(LocalCache(ttl=0, max_entries=100000), stale=0)
+
+
 def parse_signed_cookie(cookie_str):
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
             return None
         id, expires, md5 = L
-        if int(expires) < time.time():
-            return None
-        user = User.get(id)
-        if user is None:
+        ttl = min(int(expires) - time.time(), _SESSION_TTL)
+        if ttl <= 0:
             return None
-        if md5 != hashlib.md5('%s-%s-%s-%s' % (id, user.password, expires, _COOKIE_KEY)).hexdigest():
-            return None
-        return user
+        return _session_cache.get_or_render(cookie_str, ttl, ('user:%s' % id, ), \
+                lambda: _verify_signed_cookie(id, expires, md5))
     except:
         return None
 
 
+def _verify_signed_cookie(id, expires, md5):
+    # returns (user, cacheable), failures are not cached. read the row itself,
+    # User's cache is not invalidated by writes in other workers:
+    user = User.find_first('where id=?', id)
+    if user is None:
+        return None, False
+    if md5 != hashlib.md5('%s-%s-%s-%s' % (id, user.password, expires, _COOKIE_KEY)).hexdigest():
+        return None, False
+    return user, True
+
+
+@interceptor('/')
+def db_interceptor(next):
+    # hold one lazy connection per request, so the pool is hit once
+    # and Model.get() can reuse instances through the identity map:
+    with db.connection():
+        return next()
+
+
 @interceptor('/')
 def user_interceptor(next):
     logging.info('try to bind user from session cookie...')
@@ -83,10 +121,12 @@ def manage_interceptor(next):
     raise seeother('/signin')
 
 
+@cached(ttl=30, vary=('user', ), tags=('blogs', ))
 @view('blogs.html')
 @get('/')
 def index():
-    blogs = Blog.find_all()
+    # blogs.html does not render content, leave the TEXT column on the server:
+    blogs = Blog.find_all(fields=('id', 'name', 'summary', 'created_at'))
     # 查找登录用户:
     # user = User.find_first('where email=?', 'test@example.com')
     return dict(blogs=blogs, user=ctx.request.user)
@@ -136,16 +176,32 @@ def _get_blogs_by_page():
     blogs = Blog.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
     return blogs, page
 
+def _get_blogs_by_cursor():
+    # keyset pagination, cost does not grow with the page number:
+    after = ctx.request.get('after', None) or None
+    before = ctx.request.get('before', None) or None
+    try:
+        r = Blog.find_page(order_by='created_at', after=after, before=before, limit=10)
+    except ValueError:
+        raise APIValueError('cursor', 'invalid cursor')
+    return r.objects, dict(next=r.next, prev=r.prev)
+
 @api
 @get('/api/blogs')
 def api_get_blogs():
     #format = ctx.request('format', '')
     format = 'html'
-    blogs, page = _get_blogs_by_page()
+    # '?cursor=1' asks for the first page with cursors instead of page numbers:
+    if ctx.request.get('after', None) or ctx.request.get('before', None) or ctx.request.get('cursor', None):
+        blogs, cursor = _get_blogs_by_cursor()
+        r = dict(blogs=blogs, cursor=cursor)
+    else:
+        blogs, page = _get_blogs_by_page()
+        r = dict(blogs=blogs, page=page)
     if format == 'html':
         for blog in blogs:
-            blog.content = markdown2.markdown(blog.content)
-    return dict(blogs=blogs, page=page)
+            blog.content = markdown(blog.content)
+    return r
 
 
 @api
@@ -209,6 +265,8 @@ def api_create_blog():
     user = ctx.request.user
     blog = Blog(user_id=user.id, user_name=user.name, name=name, summary=summary, content=content)
     blog.insert()
+    # render now so readers never pay for it:
+    markdown(content)
     return blog
 
 
@@ -247,6 +305,7 @@ def api_update_blog(bid):
     blog.summary = summary
     blog.content = content
     blog.update()
+    markdown(content)
     return blog
 
 
@@ -264,16 +323,19 @@ def api_get_blogs(bid):
 @view('manage_blog_list.html')
 @get('/manage/blogs')
 def manage_blogs():
-    return dict(page_index=_get_page_index(), user=ctx.request.user)
+    return dict(page_index=_get_page_index(), after=ctx.request.get('after', ''), before=ctx.request.get('before', ''), user=ctx.request.user)
 
 
+# up to 1000 comments, rendered once and served from the response cache
+# until the blog or its comments change:
+@cached(ttl=30, vary=('user', ), tags=('blog:{0}', ))
 @view('blog_detail.html')
 @get('/blog/:bid')
 def get_blog(bid):
     blog = Blog.get(bid)
     if blog is None:
         raise notfound()
-    blog.html_content = markdown2.markdown(blog.content)
+    blog.html_content = markdown(blog.content)
     comments = Comment.find_by('where blog_id=? order by created_at desc limit 1000', bid)
     user = ctx.request.user
     return dict(blog=blog, comments=comments, user=user)
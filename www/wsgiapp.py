@@ -14,15 +14,17 @@ import os, time
 from datetime import datetime
 
 import db
-from web import WSGIApplication, Jinja2TemplateEngine
+import server
+from web import WSGIApplication, Jinja2TemplateEngine, fragment
 
 from config import configs
 
-# init db:
+# init db, prefork workers open their own connections:
 db.create_engine(**configs.db)
+server.after_fork(db.reset_after_fork)
 
 # init wsgi app:
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), compress=configs.compress)
 
 
 # 定义datetime_filter, input:t, output unicode string
@@ -40,20 +42,33 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'), \
+        bytecode_cache=configs.template.bytecode_cache, auto_reload=configs.template.auto_reload)
 
 # add datetime_filter
 template_engine.add_filter('datetime', datetime_filter)
 
+# {% call fragment('key', ttl) %}...{% endcall %} caches part of a page:
+template_engine.add_global('fragment', fragment)
+
+# warm up templates, filters must be added before:
+if configs.template.precompile:
+    template_engine.precompile()
+
 wsgi.template_engine = template_engine
 
 import urls
 
+wsgi.add_interceptor(urls.db_interceptor)
 wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)
 
 if __name__ == '__main__':
     # logging.info(os.path.abspath(__file__))
-    wsgi.run(9000)
+    # workers=0 and threads=1 runs the debug server, set workers and threads
+    # in config_override.py for production, threads at most the db pool size:
+    wsgi.run(configs.server.port, host=configs.server.host, workers=configs.server.workers, threads=configs.server.threads, \
+            queue_size=configs.server.queue_size, deadline=configs.server.deadline, event_loop=configs.server.event_loop, \
+            static_files=configs.server.static_files)
 